@@ -0,0 +1,241 @@
+"""SQLite index of the analyses persisted under results/, with retention.
+
+Every analysis folder written by the API is listed with its size, creation
+time and metrics, so listing analyses and enforcing the retention policy
+never scan the results folder. Eviction deletes the oldest analyses first:
+those older than the TTL, then as many as needed to fit the disk quota.
+reconcile() brings the index and the folder back in line at startup.
+"""
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_NAME = 'analysis_summary.json'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS analyses (
+    analysis_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    num_differences INTEGER,
+    similarity REAL,
+    difference_percentage REAL,
+    alignment_method TEXT,
+    parameters TEXT
+);
+CREATE INDEX IF NOT EXISTS analyses_created_at ON analyses (created_at);
+'''
+
+COLUMNS = ('analysis_id', 'created_at', 'size_bytes', 'num_differences', 'similarity', 'difference_percentage',
+           'alignment_method', 'parameters')
+
+
+def is_analysis_id(name):
+    try:
+        return str(uuid.UUID(name)) == name
+    except ValueError:
+        return False
+
+
+def folder_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def summary_timestamp(summary, default):
+    try:
+        return datetime.fromisoformat(summary['timestamp']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return default
+
+
+def latest_mtime(entry):
+    """Last modification of a file, or of a directory and anything below it"""
+    latest = entry.stat().st_mtime
+    if entry.is_dir(follow_symlinks=False):
+        for root, dirs, files in os.walk(entry.path):
+            for name in dirs + files:
+                try:
+                    latest = max(latest, os.lstat(os.path.join(root, name)).st_mtime)
+                except OSError:
+                    pass
+    return latest
+
+
+def remove_stale_entries(folder, older_than):
+    """Delete files and subdirectories of folder untouched for more than older_than seconds; returns the count"""
+    removed = 0
+    cutoff = time.time() - older_than
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if latest_mtime(entry) >= cutoff:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+            removed += 1
+        except OSError as e:
+            logger.warning(f"Cannot remove {entry.path}: {e}")
+    return removed
+
+
+class AnalysisIndex:
+    def __init__(self, folder, ttl_seconds=0, max_bytes=0):
+        """Index of folder/<analysis_id>/ stored in folder/index.sqlite3; 0 disables a limit"""
+        self.folder = folder
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.path = os.path.join(folder, 'index.sqlite3')
+        self._lock = threading.Lock()
+        self._db = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _connect(self):
+        # Opened on first use, so worker processes importing the app never touch the database
+        if self._db is None:
+            os.makedirs(self.folder, exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+            self._db = db
+        return self._db
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def add(self, analysis_id, summary, size_bytes, created_at=None):
+        """List a persisted analysis from its summary"""
+        created_at = created_at if created_at is not None else summary_timestamp(summary, time.time())
+        self._execute('INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+            analysis_id, created_at, size_bytes, summary.get('num_differences'), summary.get('similarity'),
+            summary.get('difference_percentage'), summary.get('alignment_method'),
+            json.dumps(summary.get('parameters'))
+        ))
+
+    def query(self, limit=50, offset=0, since=None, until=None, alignment_method=None):
+        """(matching analyses newest first, their total count and bytes); since/until are epoch seconds"""
+        where, params = [], []
+        if since is not None:
+            where.append('created_at >= ?')
+            params.append(since)
+        if until is not None:
+            where.append('created_at < ?')
+            params.append(until)
+        if alignment_method:
+            where.append('alignment_method = ?')
+            params.append(alignment_method)
+        clause = ' WHERE ' + ' AND '.join(where) if where else ''
+        rows = self._execute(f'SELECT {", ".join(COLUMNS)} FROM analyses{clause} '
+                             f'ORDER BY created_at DESC LIMIT ? OFFSET ?', (*params, limit, offset))
+        (count, total_bytes), = self._execute(
+            f'SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM analyses{clause}', params)
+        analyses = []
+        for row in rows:
+            entry = dict(zip(COLUMNS, row))
+            entry['created_at'] = datetime.fromtimestamp(entry['created_at']).isoformat()
+            entry['parameters'] = json.loads(entry['parameters']) if entry['parameters'] else None
+            analyses.append(entry)
+        return analyses, count, total_bytes
+
+    def stats(self):
+        (count, total_bytes), = self._execute('SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM analyses')
+        return {'analyses': count, 'bytes': total_bytes, 'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl_seconds}
+
+    def _remove(self, analysis_ids):
+        for analysis_id in analysis_ids:
+            shutil.rmtree(os.path.join(self.folder, analysis_id), ignore_errors=True)
+            self._execute('DELETE FROM analyses WHERE analysis_id = ?', (analysis_id,))
+
+    def evict(self):
+        """Delete analyses past the TTL, then the oldest beyond max_bytes; returns (count, bytes) removed"""
+        expired = []
+        if self.ttl_seconds > 0:
+            expired = self._execute('SELECT analysis_id, size_bytes FROM analyses WHERE created_at < ?',
+                                    (time.time() - self.ttl_seconds,))
+        self._remove(analysis_id for analysis_id, _ in expired)
+        over_quota = []
+        if self.max_bytes > 0:
+            (total,), = self._execute('SELECT COALESCE(SUM(size_bytes), 0) FROM analyses')
+            if total > self.max_bytes:
+                for analysis_id, size in self._execute('SELECT analysis_id, size_bytes FROM analyses '
+                                                       'ORDER BY created_at'):
+                    if total <= self.max_bytes:
+                        break
+                    over_quota.append((analysis_id, size))
+                    total -= size
+        self._remove(analysis_id for analysis_id, _ in over_quota)
+        removed = expired + over_quota
+        if removed:
+            logger.info(f"Evicted {len(expired)} expired and {len(over_quota)} over-quota analyses "
+                        f"({sum(size for _, size in removed) / (1024 * 1024):.1f} MB)")
+        return len(removed), sum(size for _, size in removed)
+
+    def reconcile(self, grace_seconds=600):
+        """Index complete analyses missing from the index, forget rows whose folder is gone and
+        delete folders without a summary (interrupted writes) older than grace_seconds.
+
+        Only folders named by an analysis id are considered, so results/cache
+        and anything else kept in the folder are left alone. Returns
+        (indexed, forgotten, removed).
+        """
+        indexed = set(analysis_id for analysis_id, in self._execute('SELECT analysis_id FROM analyses'))
+        on_disk = set()
+        added = removed = 0
+        cutoff = time.time() - grace_seconds
+        for entry in os.scandir(self.folder):
+            if not entry.is_dir() or not is_analysis_id(entry.name):
+                continue
+            on_disk.add(entry.name)
+            if entry.name in indexed:
+                continue
+            summary_path = os.path.join(entry.path, SUMMARY_NAME)
+            try:
+                with open(summary_path) as f:
+                    summary = json.load(f)
+            except (OSError, ValueError):
+                if entry.stat().st_mtime < cutoff:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+                continue
+            self.add(entry.name, summary, folder_size(entry.path),
+                     summary_timestamp(summary, os.path.getmtime(summary_path)))
+            added += 1
+        forgotten = indexed - on_disk
+        for analysis_id in forgotten:
+            self._execute('DELETE FROM analyses WHERE analysis_id = ?', (analysis_id,))
+        return added, len(forgotten), removed
+
+    def start(self, interval):
+        """Run evict() every interval seconds on a daemon thread"""
+        if self._thread is not None:
+            return
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.evict()
+                except Exception as e:
+                    logger.error(f"Eviction failed: {e}")
+        self._thread = threading.Thread(target=run, name='evict', daemon=True)
+        self._thread.start()
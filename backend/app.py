@@ -1,26 +1,76 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Request, g, request, jsonify, send_from_directory, stream_with_context, url_for
 from flask_cors import CORS
 import cv2
 import numpy as np
 import base64
+import io
+import json
 import os
+import sqlite3
+import threading
+import time
 import uuid
 from datetime import datetime
-from skimage.metrics import structural_similarity as ssim
-from werkzeug.utils import secure_filename
-import tempfile
-import shutil
+from fast_ssim import structural_similarity
 import logging
-from functools import wraps
+from concurrent.futures import FIRST_COMPLETED, CancelledError, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+from functools import cached_property, wraps
+from worker_pool import ComparisonPool, JobTimeoutError, PoolBusyError
+from jobs import JobManager, JobQueueFullError, JobRejectedError, job_id_for_key, job_key
+from result_cache import ResultCache, cache_key, upload_digest
+from references import ReferenceStore, is_reference_id, keypoints_from_array, keypoints_to_array, reference_id_for
+from analysis_index import AnalysisIndex, remove_stale_entries
+from instrumentation import SamplingProfiler, Trace, merge_trace, stage, stage_metrics, timed
+
+
+class InMemoryUploadRequest(Request):
+    """Keep multipart uploads in memory instead of spooling them to disk.
+
+    Uploads are capped by MAX_CONTENT_LENGTH, so holding them in a BytesIO
+    is bounded and lets the decoder read them without a copy.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
 
 app = Flask(__name__)
+app.request_class = InMemoryUploadRequest
 CORS(app)
 
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 RESULTS_FOLDER = 'results'
+REFERENCES_FOLDER = 'references'
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
-MAX_RESOLUTION = 1500  # Reduced from 2000 to 1500 pixels
+MAX_RESOLUTION = int(os.environ.get('MAX_RESOLUTION', 1500))  # Reduced from 2000 to 1500 pixels
+PYRAMID_MIN_SIZE = 200  # Coarsest pyramid level keeps at least this many pixels per side
+PYRAMID_MAX_LEVELS = 4
+PHASE_REFINE_WINDOW = 512  # Crop used to refine phase correlation on finer levels
+PHASE_REFINE_MAX_RESIDUAL = 4.0  # Pixels a finer level may move the coarse estimate
+FEATURES_PYRAMID_SIZE = 800  # Longest side ORB runs at in features_pyramid mode
+SSIM_DOWNSAMPLE = 1  # Score SSIM on 1/N-size copies (1 = working resolution)
+ORB_FEATURES = 5000  # Keypoints per image in features mode
+# Tiled detection bounds the per-stage buffers for large working sizes (0 = full frame)
+DETECTION_TILE_SIZE = int(os.environ.get('DETECTION_TILE_SIZE', 0))
+DETECTION_TILE_THREADS = int(os.environ.get('DETECTION_TILE_THREADS', os.cpu_count() or 1))
+DETECTION_HALO = 16  # Context around a tile: blur (1) + close (4) + open (2) + median (2) px, rounded up
+MIN_CIRCULARITY = 0.1  # 4*pi*area/perimeter^2 below this is a sliver or seam, not a difference
+FOUR_NEIGHBOURS = np.float32([[0, 1, 0], [1, 0, 1], [0, 1, 0]])
+MAX_LABELS = int(os.environ.get('MAX_LABELS', 200))  # Numbered boxes on marked images; the rest are unlabelled
+# Pairs whose unaligned blurred absdiff stays within this many gray levels skip alignment (0 disables)
+PRESCREEN_MAX_DIFFERENCE = int(os.environ.get('PRESCREEN_MAX_DIFFERENCE', 12))
+PRESCREEN_THUMBNAIL_FACTOR = 8  # Downscale of the thumbnails that reject most pairs before the full check
+# Alignments scoring below these fail with AlignmentError instead of comparing misregistered images (0 disables)
+ALIGNMENT_MIN_QUALITY = {
+    'response': float(os.environ.get('ALIGNMENT_MIN_RESPONSE', 0.1)),  # Phase correlation peak
+    'cc': float(os.environ.get('ALIGNMENT_MIN_CC', 0.5)),  # ECC correlation coefficient
+    'inliers': float(os.environ.get('ALIGNMENT_MIN_INLIERS', 20))  # RANSAC inliers among the 100 best matches
+}
+ALIGNMENT_METHODS = ('phase', 'phase_pyramid', 'ecc', 'ecc_pyramid', 'features', 'features_pyramid')
+# auto mode runs these aligners from the cheapest and keeps the first reaching its minimum quality
+AUTO_ALIGNMENT = os.environ.get('AUTO_ALIGNMENT_STEPS', 'phase:0.3,ecc_pyramid:0.8,features:20')
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -34,9 +84,145 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['RESULTS_FOLDER'] = RESULTS_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
+# Worker pool (set WORKER_PROCESSES > 0 to run comparisons in separate processes)
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', 0))
+WORKER_QUEUE_DEPTH = int(os.environ.get('WORKER_QUEUE_DEPTH', 8))
+WORKER_JOB_TIMEOUT = float(os.environ.get('WORKER_JOB_TIMEOUT', 170))  # Below the mobile client's 180s
+RETRY_AFTER_SECONDS = 10
+
+# Result artifacts: name -> (results key, file extension, imencode params).
+# Each is encoded once; the same bytes go to disk and into the response. The three images a response
+# can carry (see RESPONSE_IMAGES) are saved at the response's quality, 75 for the originals and 80 for
+# the marked superposition, rather than 95, so a full response costs no extra encode; the other JPEGs
+# keep the quality cv2.imwrite has always saved them with.
+ARTIFACT_JPEG_QUALITY = int(os.environ.get('ARTIFACT_JPEG_QUALITY', 95))
+ARTIFACTS = {
+    'image1_original': ('img1_original', '.jpg', [cv2.IMWRITE_JPEG_QUALITY, 75]),
+    'image2_original': ('img2_original', '.jpg', [cv2.IMWRITE_JPEG_QUALITY, 75]),
+    'image1_marked': ('img1_marked', '.jpg', [cv2.IMWRITE_JPEG_QUALITY, ARTIFACT_JPEG_QUALITY]),
+    'image2_marked': ('img2_marked', '.jpg', [cv2.IMWRITE_JPEG_QUALITY, ARTIFACT_JPEG_QUALITY]),
+    'superposition': ('superposition', '.jpg', [cv2.IMWRITE_JPEG_QUALITY, ARTIFACT_JPEG_QUALITY]),
+    'superposition_marked': ('superposition_marked', '.jpg', [cv2.IMWRITE_JPEG_QUALITY, 80]),
+    'difference_map': ('difference_map', '.jpg', [cv2.IMWRITE_JPEG_QUALITY, ARTIFACT_JPEG_QUALITY]),
+    # Binary mask: 1-bit PNG is lossless and a fraction of a JPEG's size
+    'threshold_map': ('threshold_map', '.png', [cv2.IMWRITE_PNG_BILEVEL, 1]),
+}
+# Artifacts written to results/<analysis_id>/ unless the request's persist field says otherwise
+PERSIST_ARTIFACTS = os.environ.get('PERSIST_ARTIFACTS', 'all')
+PERSIST_THREADS = int(os.environ.get('PERSIST_THREADS', 4))
+# Retention of results/<analysis_id>/, enforced from results/index.sqlite3 (0 disables a limit)
+RESULTS_TTL_HOURS = float(os.environ.get('RESULTS_TTL_HOURS', 24 * 30))
+RESULTS_MAX_MB = int(os.environ.get('RESULTS_MAX_MB', 2048))
+RESULTS_EVICTION_INTERVAL = float(os.environ.get('RESULTS_EVICTION_INTERVAL', 300))
+ORPHAN_GRACE_SECONDS = 600  # Unfinished analysis folders and uploads younger than this are left alone at startup
+ANALYSES_MAX_LIMIT = 500  # Page size cap of GET /analyses
+
+# Images /compare_images can return: response name -> artifact name
+RESPONSE_IMAGES = {
+    'original_image1': 'image1_original',
+    'original_image2': 'image2_original',
+    'difference_image': 'superposition_marked',
+}
+RESPONSE_MODES = ('full', 'metrics', 'urls', 'multipart')
+
+# Result cache: aligned pairs and detections of recently seen uploads
+CACHE_MAX_MB = int(os.environ.get('CACHE_MAX_MB', 256))
+CACHE_DISK_MAX_MB = int(os.environ.get('CACHE_DISK_MAX_MB', 0))  # 0 disables results/cache/
+
+# Batch comparisons (POST /compare_batch)
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 50))
+BATCH_MAX_CONTENT_LENGTH = int(os.environ.get('BATCH_MAX_CONTENT_LENGTH', 128 * 1024 * 1024))
+BATCH_THREADS = int(os.environ.get('BATCH_THREADS', os.cpu_count() or 1))  # Without a worker pool
+
+# Registered reference images kept decoded in memory, per process
+REFERENCES_LOADED = int(os.environ.get('REFERENCES_LOADED', 8))
+
+# Sampling profiler: requests with profile=true write collapsed stacks here ('' disables it)
+PROFILE_FOLDER = os.environ.get('PROFILE_FOLDER', '')
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+
+# Background jobs (POST /jobs)
+JOB_THREADS = int(os.environ.get('JOB_THREADS', max(WORKER_PROCESSES, 1)))
+JOB_MAX_PENDING = int(os.environ.get('JOB_MAX_PENDING', 32))
+
 # API Key (set via environment variable or default)
 API_KEY = os.environ.get('API_KEY', 'your_secure_api_key')
 
+# JPEG decoders can skip DCT work when asked for a 1/2, 1/4 or 1/8 image
+REDUCED_DECODE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def decode_image(data, flags=cv2.IMREAD_COLOR):
+    """Decode an encoded image (bytes, bytearray or memoryview) without copying it"""
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if buf.size == 0:
+        return None
+    return cv2.imdecode(buf, flags)
+
+def read_jpeg_size(data):
+    """Return (width, height) from a JPEG header, or None if data is not a JPEG"""
+    view = memoryview(data)
+    if len(view) < 4 or view[0] != 0xFF or view[1] != 0xD8:
+        return None
+    pos = 2
+    while pos + 4 <= len(view):
+        if view[pos] != 0xFF:
+            return None
+        marker = view[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            pos += 2
+            continue
+        length = (view[pos + 2] << 8) | view[pos + 3]
+        if marker in JPEG_SOF_MARKERS:
+            if pos + 9 > len(view):
+                return None
+            height = (view[pos + 5] << 8) | view[pos + 6]
+            width = (view[pos + 7] << 8) | view[pos + 8]
+            return width, height
+        pos += 2 + length
+    return None
+
+@timed('decode')
+def decode_image_reduced(data, max_dim):
+    """Decode an image at the smallest JPEG scale that still covers max_dim.
+
+    Returns (image, original_size) where original_size is the (width, height)
+    of the full-resolution image, so coordinates can be mapped back to it.
+    """
+    size = read_jpeg_size(data)
+    factor = 1
+    if size is not None:
+        for candidate in sorted(REDUCED_DECODE_FLAGS, reverse=True):
+            if max(size) / candidate >= max_dim:
+                factor = candidate
+                break
+    image = decode_image(data, REDUCED_DECODE_FLAGS.get(factor, cv2.IMREAD_COLOR))
+    if image is None:
+        return None, None
+    h, w = image.shape[:2]
+    if size is None:
+        return image, (w, h)
+    # imdecode applies EXIF orientation, the SOF header does not
+    if (w > h) != (size[0] > size[1]):
+        size = (size[1], size[0])
+    if factor > 1:
+        logger.info(f"Reduced decode 1/{factor}: {size[0]}x{size[1]} -> {w}x{h}")
+    return image, size
+
+def read_upload(file_storage):
+    """Return a zero-copy view of an uploaded file's bytes when possible"""
+    stream = file_storage.stream
+    if isinstance(stream, io.BytesIO):
+        return stream.getbuffer()
+    return file_storage.read()
+
 def require_api_key(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -46,34 +232,210 @@ def require_api_key(f):
         return f(*args, **kwargs)
     return decorated
 
+def traced(f):
+    """Time the stages a view runs into one Trace, available as g.trace"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        with Trace() as trace:
+            g.trace = trace
+            return f(*args, **kwargs)
+    return decorated
+
+def build_pyramid(image):
+    """Gaussian pyramid from full resolution (level 0) down to ~PYRAMID_MIN_SIZE"""
+    pyramid = [image]
+    while len(pyramid) < PYRAMID_MAX_LEVELS and min(pyramid[-1].shape[:2]) // 2 >= PYRAMID_MIN_SIZE:
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return pyramid
+
+def iter_tiles(height, width, tile_size, halo=DETECTION_HALO):
+    """(core, padded, inner) slice pairs covering an image tile by tile.
+
+    core is the tile's region of the image, padded the same region grown by
+    halo pixels (clipped to the image) and inner the core's place in padded.
+    """
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            y1, x1 = min(y0 + tile_size, height), min(x0 + tile_size, width)
+            py0, px0 = max(y0 - halo, 0), max(x0 - halo, 0)
+            py1, px1 = min(y1 + halo, height), min(x1 + halo, width)
+            yield ((slice(y0, y1), slice(x0, x1)),
+                   (slice(py0, py1), slice(px0, px1)),
+                   (slice(y0 - py0, y1 - py0), slice(x0 - px0, x1 - px0)))
+
+tile_executor = ThreadPoolExecutor(max_workers=DETECTION_TILE_THREADS, thread_name_prefix='tile')
+
+def phase_spectrum(gray_float):
+    """DFT (CCS-packed) of an image zero-padded to an optimal size, as cv2.phaseCorrelate computes it"""
+    h, w = gray_float.shape[:2]
+    rows, cols = cv2.getOptimalDFTSize(h), cv2.getOptimalDFTSize(w)
+    padded = cv2.copyMakeBorder(gray_float, 0, rows - h, 0, cols - w, cv2.BORDER_CONSTANT, value=0)
+    return cv2.dft(padded)
+
+def normalize_ccs(spectrum):
+    """Scale every complex value of a CCS-packed spectrum to unit magnitude, in place"""
+    eps = np.float32(np.finfo(np.float32).eps)
+    rows, cols = spectrum.shape
+    # Columns 1..: interleaved (re, im) pairs
+    body = spectrum[:, 1:cols - 1 if cols % 2 == 0 else cols]
+    values = np.ascontiguousarray(body).view(np.complex64)
+    values /= np.abs(values) + eps
+    body[...] = values.view(np.float32)
+    # Column 0 (and the last one for even widths) pack a 1D spectrum vertically
+    for c in ([0, cols - 1] if cols % 2 == 0 else [0]):
+        column = np.ascontiguousarray(spectrum[:, c])
+        pairs = column[1:rows - 1 if rows % 2 == 0 else rows].reshape(-1, 2)
+        pairs /= np.sqrt(pairs[:, 0] ** 2 + pairs[:, 1] ** 2)[:, None] + eps
+        column[0] /= abs(column[0]) + eps
+        if rows % 2 == 0:
+            column[-1] /= abs(column[-1]) + eps
+        spectrum[:, c] = column
+    return spectrum
+
+def phase_correlate(spectrum1, spectrum2):
+    """cv2.phaseCorrelate on precomputed spectra: returns (shift, response)"""
+    cross = normalize_ccs(cv2.mulSpectrums(spectrum1, spectrum2, 0, conjB=True))
+    surface = cv2.idft(cross, flags=cv2.DFT_REAL_OUTPUT)
+    rows, cols = surface.shape
+    surface = np.roll(surface, (rows // 2, cols // 2), axis=(0, 1))
+    _, _, _, (px, py) = cv2.minMaxLoc(surface)
+    # Sub-pixel peak: centroid of the 5x5 neighbourhood
+    y0, y1 = max(py - 2, 0), min(py + 2, rows - 1)
+    x0, x1 = max(px - 2, 0), min(px + 2, cols - 1)
+    weights = surface[y0:y1 + 1, x0:x1 + 1].astype(np.float64)
+    total = weights.sum()
+    if not total > 0:
+        return (0.0, 0.0), 0.0  # Flat images: no peak to locate
+    ys, xs = np.mgrid[y0:y1 + 1, x0:x1 + 1]
+    peak_x, peak_y = (xs * weights).sum() / total, (ys * weights).sum() / total
+    # Measured from the roll's centre; cv2.phaseCorrelate uses size / 2.0, which is half a pixel off for odd sizes
+    return (cols // 2 - peak_x, rows // 2 - peak_y), total / (rows * cols)
+
+class ImageFrame:
+    """A BGR image plus the derived views the pipeline stages need.
+
+    Each view is computed on first access and then shared, so aligning,
+    detecting and scoring the same image converts it to grayscale only once.
+    """
+    def __init__(self, bgr):
+        self.bgr = bgr
+    
+    @classmethod
+    def with_views(cls, bgr, **views):
+        """Frame whose views were computed earlier, e.g. a registered reference"""
+        frame = cls(bgr)
+        frame.__dict__.update(views)
+        return frame
+    
+    @property
+    def shape(self):
+        return self.bgr.shape
+    
+    @cached_property
+    def gray(self):
+        return cv2.cvtColor(self.bgr, cv2.COLOR_BGR2GRAY)
+    
+    @cached_property
+    def blurred(self):
+        return cv2.GaussianBlur(self.gray, (3, 3), 0)
+    
+    @cached_property
+    def gray_float(self):
+        return np.float32(self.gray)
+    
+    @cached_property
+    def gray_pyramid(self):
+        return build_pyramid(self.gray)
+    
+    @cached_property
+    def gray_float_pyramid(self):
+        return build_pyramid(self.gray_float)
+    
+    @cached_property
+    def gray_spectrum(self):
+        return phase_spectrum(self.gray_float)
+    
+    @cached_property
+    def orb_features(self):
+        """ORB keypoints and descriptors of the gray image"""
+        return cv2.ORB_create(nfeatures=ORB_FEATURES).detectAndCompute(self.gray, None)
+    
+    def release(self, *names):
+        """Drop cached views that later stages no longer need"""
+        for name in names:
+            self.__dict__.pop(name, None)
+
+class AlignmentError(Exception):
+    """Raised when an alignment scores below ALIGNMENT_MIN_QUALITY; quality holds the signal"""
+    def __init__(self, message, quality=None):
+        super().__init__(message)
+        self.quality = quality
+    
+    def __reduce__(self):
+        # Keeps quality when raised in a worker process
+        return type(self), (str(self), self.quality)
+
+def parse_alignment_steps(value):
+    """[(method, minimum quality)] from 'method:minimum,...'; raises ValueError on unknown methods"""
+    steps = []
+    for step in value.split(','):
+        method, separator, minimum = step.strip().partition(':')
+        if method not in ALIGNMENT_METHODS or not separator:
+            raise ValueError(f"AUTO_ALIGNMENT_STEPS: {step.strip()!r} is not method:minimum with a method among "
+                             f"{', '.join(ALIGNMENT_METHODS)}")
+        steps.append((method, float(minimum)))
+    return steps
+
+AUTO_ALIGNMENT_STEPS = parse_alignment_steps(AUTO_ALIGNMENT)
+
+def as_frame(image):
+    return image if isinstance(image, ImageFrame) else ImageFrame(image)
+
 class PreciseImageDifferenceDetector:
     def __init__(self):
         self.resize_method = cv2.INTER_LANCZOS4
         self.alignment_method = "phase"
+        self.ssim_threshold = None  # Also flag pixels whose local SSIM falls below this
+        self.tile_size = DETECTION_TILE_SIZE or None
+        self.alignment_quality = None  # Quality signal of the last alignment
     
     def set_alignment_method(self, method):
         self.alignment_method = method
         logger.info(f"Alignment method set to: {method}")
     
+    def record_alignment(self, metric, value):
+        """Keep an aligner's quality signal; value None means it found no transform at all"""
+        self.alignment_quality = {'method': self.alignment_method, 'metric': metric, 'value': value}
+    
     def align_images_with_features(self, img1, img2):
         logger.info("Aligning with feature points...")
-        gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
-        gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+        frame1, frame2 = as_frame(img1), as_frame(img2)
+        kp1, des1 = frame1.orb_features
+        kp2, des2 = frame2.orb_features
+        M = self.match_homography(kp1, des1, kp2, des2)
+        if M is None:
+            return frame1, frame2
         
-        orb = cv2.ORB_create(nfeatures=5000)
-        kp1, des1 = orb.detectAndCompute(gray1, None)
-        kp2, des2 = orb.detectAndCompute(gray2, None)
+        h, w = frame2.shape[:2]
+        img1_aligned = cv2.warpPerspective(frame1.bgr, M, (w, h))
+        angle = np.arctan2(M[1, 0], M[0, 0]) * 180 / np.pi
+        logger.info(f"Detected rotation: {angle:.2f}°")
         
+        return ImageFrame(img1_aligned), frame2
+    
+    def match_homography(self, kp1, des1, kp2, des2):
+        """RANSAC homography of the 100 best ORB matches, or None; records the inlier count"""
+        self.record_alignment('inliers', 0)
         if des1 is None or des2 is None:
             logger.warning("Not enough feature points found!")
-            return img1, img2
+            return None
         
         bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
         matches = bf.match(des1, des2)
         
         if len(matches) < 10:
             logger.warning("Not enough matches found!")
-            return img1, img2
+            return None
         
         matches = sorted(matches, key=lambda x: x.distance)
         src_pts = np.float32([kp1[m.queryIdx].pt for m in matches[:100]]).reshape(-1, 1, 2)
@@ -83,19 +445,16 @@ class PreciseImageDifferenceDetector:
         
         if M is None:
             logger.warning("Cannot calculate transformation!")
-            return img1, img2
-        
-        h, w = img2.shape[:2]
-        img1_aligned = cv2.warpPerspective(img1, M, (w, h))
-        angle = np.arctan2(M[1, 0], M[0, 0]) * 180 / np.pi
-        logger.info(f"Detected rotation: {angle:.2f}°")
-        
-        return img1_aligned, img2
+            return None
+        inliers = int(mask.sum())
+        logger.info(f"RANSAC inliers: {inliers}/{len(src_pts)}")
+        self.record_alignment('inliers', inliers)
+        return M
     
     def align_images_ecc(self, img1, img2):
         logger.info("Aligning with ECC...")
-        gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
-        gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+        frame1, frame2 = as_frame(img1), as_frame(img2)
+        gray1, gray2 = frame1.gray, frame2.gray
         
         warp_mode = cv2.MOTION_EUCLIDEAN
         warp_matrix = np.eye(2, 3, dtype=np.float32)
@@ -103,118 +462,551 @@ class PreciseImageDifferenceDetector:
         
         try:
             (cc, warp_matrix) = cv2.findTransformECC(gray1, gray2, warp_matrix, warp_mode, criteria)
-            img1_aligned = cv2.warpAffine(img1, warp_matrix, (img2.shape[1], img2.shape[0]))
+            img1_aligned = cv2.warpAffine(frame1.bgr, warp_matrix, (frame2.shape[1], frame2.shape[0]))
             angle = np.arctan2(warp_matrix[1, 0], warp_matrix[0, 0]) * 180 / np.pi
             logger.info(f"Detected rotation: {angle:.2f}°")
             logger.info(f"Correlation: {cc:.3f}")
-            return img1_aligned, img2
+            self.record_alignment('cc', float(cc))
+            return ImageFrame(img1_aligned), frame2
         except cv2.error as e:
             logger.error(f"ECC error: {e}")
-            return img1, img2
+            self.record_alignment('cc', None)
+            return frame1, frame2
     
     def align_images_phase_correlation(self, img1, img2):
         logger.info("Aligning with phase correlation...")
-        gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
-        gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+        frame1, frame2 = as_frame(img1), as_frame(img2)
         
-        shift, response = cv2.phaseCorrelate(np.float32(gray1), np.float32(gray2))
+        shift, response = phase_correlate(frame1.gray_spectrum, frame2.gray_spectrum)
         logger.info(f"Detected shift: ({shift[0]:.2f}, {shift[1]:.2f})")
         logger.info(f"Quality: {response:.3f}")
+        self.record_alignment('response', float(response))
         
         M = np.float32([[1, 0, shift[0]], [0, 1, shift[1]]])
-        img1_aligned = cv2.warpAffine(img1, M, (img2.shape[1], img2.shape[0]))
+        img1_aligned = cv2.warpAffine(frame1.bgr, M, (frame2.shape[1], frame2.shape[0]))
         
-        return img1_aligned, img2
+        return ImageFrame(img1_aligned), frame2
+    
+    def align_images_ecc_pyramid(self, img1, img2, finest_level=1):
+        """ECC estimated on the coarsest level, refined up to finest_level, warped once at full size"""
+        logger.info("Aligning with pyramid ECC...")
+        frame1, frame2 = as_frame(img1), as_frame(img2)
+        gray1 = frame1.gray
+        pyr1, pyr2 = frame1.gray_pyramid, frame2.gray_pyramid
+        coarsest = len(pyr1) - 1
+        finest_level = min(finest_level, coarsest)
+        
+        warp_mode = cv2.MOTION_EUCLIDEAN
+        warp_matrix = np.eye(2, 3, dtype=np.float32)
+        
+        try:
+            for level in range(coarsest, finest_level - 1, -1):
+                iterations = 50 if level == coarsest else 15
+                criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, iterations, 0.001)
+                (cc, warp_matrix) = cv2.findTransformECC(pyr1[level], pyr2[level], warp_matrix, warp_mode, criteria)
+                if level > finest_level:
+                    warp_matrix[:, 2] *= pyr1[level - 1].shape[1] / pyr1[level].shape[1]
+        except cv2.error as e:
+            logger.error(f"ECC error: {e}")
+            self.record_alignment('cc', None)
+            return frame1, frame2
+        
+        self.record_alignment('cc', float(cc))
+        warp_matrix[:, 2] *= gray1.shape[1] / pyr1[finest_level].shape[1]
+        img1_aligned = cv2.warpAffine(frame1.bgr, warp_matrix, (frame2.shape[1], frame2.shape[0]))
+        angle = np.arctan2(warp_matrix[1, 0], warp_matrix[0, 0]) * 180 / np.pi
+        logger.info(f"Pyramid levels: {coarsest + 1}, refined down to level {finest_level}")
+        logger.info(f"Detected rotation: {angle:.2f}°")
+        logger.info(f"Correlation: {cc:.3f}")
+        return ImageFrame(img1_aligned), frame2
+    
+    def refine_shift(self, gray1, gray2, shift):
+        """Phase-correlate a window of gray2 against gray1 pre-shifted by the integer part of shift"""
+        h, w = gray2.shape[:2]
+        dx, dy = int(round(shift[0])), int(round(shift[1]))
+        x0, x1 = max(0, dx), min(w, w + dx)
+        y0, y1 = max(0, dy), min(h, h + dy)
+        half = PHASE_REFINE_WINDOW // 2
+        cx, cy = (x0 + x1) // 2, (y0 + y1) // 2
+        x0, x1 = max(x0, cx - half), min(x1, cx + half)
+        y0, y1 = max(y0, cy - half), min(y1, cy + half)
+        if x1 - x0 < 16 or y1 - y0 < 16:
+            return shift, 0.0
+        window1 = gray1[y0 - dy:y1 - dy, x0 - dx:x1 - dx]
+        window2 = gray2[y0:y1, x0:x1]
+        hanning = cv2.createHanningWindow((x1 - x0, y1 - y0), cv2.CV_32F)
+        residual, response = cv2.phaseCorrelate(window1, window2, hanning)
+        # A coarse estimate is off by a pixel or two at the next level; anything
+        # larger means the window locked onto a wrong peak
+        if max(abs(dx + residual[0] - shift[0]), abs(dy + residual[1] - shift[1])) > PHASE_REFINE_MAX_RESIDUAL:
+            logger.warning(f"Discarding phase refinement residual ({residual[0]:.2f}, {residual[1]:.2f})")
+            return shift, response
+        return (dx + residual[0], dy + residual[1]), response
+    
+    def align_images_phase_pyramid(self, img1, img2, finest_level=0):
+        """Phase correlation on the coarsest level, refined on windows of the finer levels"""
+        logger.info("Aligning with pyramid phase correlation...")
+        frame1, frame2 = as_frame(img1), as_frame(img2)
+        gray1 = frame1.gray_float
+        pyr1, pyr2 = frame1.gray_float_pyramid, frame2.gray_float_pyramid
+        coarsest = len(pyr1) - 1
+        
+        hanning = cv2.createHanningWindow((pyr1[coarsest].shape[1], pyr1[coarsest].shape[0]), cv2.CV_32F)
+        shift, response = cv2.phaseCorrelate(pyr1[coarsest], pyr2[coarsest], hanning)
+        for level in range(coarsest - 1, finest_level - 1, -1):
+            scale = pyr1[level].shape[1] / pyr1[level + 1].shape[1]
+            shift, response = self.refine_shift(pyr1[level], pyr2[level], (shift[0] * scale, shift[1] * scale))
+        scale = gray1.shape[1] / pyr1[finest_level].shape[1]
+        shift = (shift[0] * scale, shift[1] * scale)
+        logger.info(f"Pyramid levels: {coarsest + 1}, refined down to level {finest_level}")
+        logger.info(f"Detected shift: ({shift[0]:.2f}, {shift[1]:.2f})")
+        logger.info(f"Quality: {response:.3f}")
+        self.record_alignment('response', float(response))
+        
+        M = np.float32([[1, 0, shift[0]], [0, 1, shift[1]]])
+        img1_aligned = cv2.warpAffine(frame1.bgr, M, (frame2.shape[1], frame2.shape[0]))
+        
+        return ImageFrame(img1_aligned), frame2
+    
+    def align_images_features_pyramid(self, img1, img2):
+        """ORB homography estimated on a reduced pyramid level and scaled back to full size"""
+        logger.info("Aligning with feature points on a reduced level...")
+        frame1, frame2 = as_frame(img1), as_frame(img2)
+        gray1 = frame1.gray
+        pyr1, pyr2 = frame1.gray_pyramid, frame2.gray_pyramid
+        level = 0
+        while level < len(pyr1) - 1 and max(pyr1[level].shape[:2]) > FEATURES_PYRAMID_SIZE:
+            level += 1
+        
+        orb = cv2.ORB_create(nfeatures=2000)
+        kp1, des1 = orb.detectAndCompute(pyr1[level], None)
+        kp2, des2 = orb.detectAndCompute(pyr2[level], None)
+        M = self.match_homography(kp1, des1, kp2, des2)
+        if M is None:
+            return frame1, frame2
+        
+        scale = gray1.shape[1] / pyr1[level].shape[1]
+        S = np.diag([scale, scale, 1.0])
+        M = S @ M @ np.linalg.inv(S)
+        
+        h, w = frame2.shape[:2]
+        img1_aligned = cv2.warpPerspective(frame1.bgr, M, (w, h))
+        angle = np.arctan2(M[1, 0], M[0, 0]) * 180 / np.pi
+        logger.info(f"Features level: {level} ({pyr1[level].shape[1]}x{pyr1[level].shape[0]})")
+        logger.info(f"Detected rotation: {angle:.2f}°")
+        
+        return ImageFrame(img1_aligned), frame2
+    
+    def align_images_auto(self, img1, img2):
+        """Escalate through AUTO_ALIGNMENT_STEPS until an aligner reaches its minimum quality.
+
+        Every attempt is listed under 'path' in alignment_quality. When none
+        qualifies the last one is kept, for check_alignment to judge.
+        """
+        frame1, frame2 = as_frame(img1), as_frame(img2)
+        path = []
+        try:
+            for method, minimum in AUTO_ALIGNMENT_STEPS:
+                self.alignment_method, self.alignment_quality = method, None
+                start = time.perf_counter()
+                aligned = self.align_images(frame1, frame2)
+                quality = self.alignment_quality or {'method': method, 'metric': None, 'value': None}
+                accepted = quality['value'] is not None and quality['value'] >= minimum
+                path.append({**quality, 'minimum': minimum, 'accepted': accepted,
+                             'ms': round((time.perf_counter() - start) * 1000, 1)})
+                if accepted:
+                    break
+                logger.info(f"Auto alignment: {method} below {minimum:g}, escalating")
+        finally:
+            self.alignment_method = 'auto'
+        logger.info(f"Auto alignment: {' -> '.join(step['method'] for step in path)}")
+        self.alignment_quality = {**quality, 'path': path}
+        return aligned
     
     def align_images(self, img1, img2):
-        if self.alignment_method == "features":
+        if self.alignment_method == "auto":
+            return self.align_images_auto(img1, img2)
+        elif self.alignment_method == "features":
             return self.align_images_with_features(img1, img2)
         elif self.alignment_method == "ecc":
             return self.align_images_ecc(img1, img2)
         elif self.alignment_method == "phase":
             return self.align_images_phase_correlation(img1, img2)
+        elif self.alignment_method == "features_pyramid":
+            return self.align_images_features_pyramid(img1, img2)
+        elif self.alignment_method == "ecc_pyramid":
+            return self.align_images_ecc_pyramid(img1, img2)
+        elif self.alignment_method == "phase_pyramid":
+            return self.align_images_phase_pyramid(img1, img2)
         else:
             logger.warning("Unknown alignment method, no alignment")
-            return img1, img2
-    
-    def resize_images_to_same_size(self, img1, img2, target_size=None):
-        h1, w1 = img1.shape[:2]
-        h2, w2 = img2.shape[:2]
-        scale = min(MAX_RESOLUTION / max(h1, h2), MAX_RESOLUTION / max(w1, w2))
-        if scale < 1:
-            img1 = cv2.resize(img1, None, fx=scale, fy=scale, interpolation=self.resize_method)
-            img2 = cv2.resize(img2, None, fx=scale, fy=scale, interpolation=self.resize_method)
-        target_w = max(w1, w2) if target_size is None else target_size[0]
-        target_h = max(h1, h2) if target_size is None else target_size[1]
-        img1_resized = cv2.resize(img1, (target_w, target_h), interpolation=self.resize_method)
-        img2_resized = cv2.resize(img2, (target_w, target_h), interpolation=self.resize_method)
-        logger.info(f"Images resized to: {target_w}x{target_h}")
+            return as_frame(img1), as_frame(img2)
+    
+    def check_alignment(self):
+        """Quality of the last alignment, or AlignmentError when it is below ALIGNMENT_MIN_QUALITY"""
+        quality = self.alignment_quality
+        if quality is None:
+            return None
+        minimum = ALIGNMENT_MIN_QUALITY.get(quality['metric'], 0)
+        if minimum > 0 and (quality['value'] is None or quality['value'] < minimum):
+            found = 'no transform' if quality['value'] is None else f"{quality['metric']} {quality['value']:.3g}"
+            raise AlignmentError(f"Images could not be aligned with {quality['method']} "
+                                 f"({found}, minimum {minimum:g})", quality)
+        return quality
+    
+    def prescreen(self, frame1, frame2):
+        """absdiff map of a pair already registered within PRESCREEN_MAX_DIFFERENCE, or None.
+
+        Thumbnails reject most pairs in about a millisecond; the full
+        map then confirms that no pixel differs by more, so there is no
+        misregistration for an aligner to correct.
+        """
+        if PRESCREEN_MAX_DIFFERENCE <= 0:
+            return None
+        factor = PRESCREEN_THUMBNAIL_FACTOR
+        h, w = frame1.shape[:2]
+        if h >= factor and w >= factor:
+            # Whole factor-sized cells keep INTER_AREA on its fast integer path
+            size = (w // factor, h // factor)
+            thumbnail1 = cv2.resize(frame1.gray[:size[1] * factor, :size[0] * factor], size,
+                                    interpolation=cv2.INTER_AREA)
+            thumbnail2 = cv2.resize(frame2.gray[:size[1] * factor, :size[0] * factor], size,
+                                    interpolation=cv2.INTER_AREA)
+            if cv2.absdiff(thumbnail1, thumbnail2).max() > PRESCREEN_MAX_DIFFERENCE:
+                return None
+        difference_map = self.difference_map(frame1, frame2)
+        if difference_map.max() > PRESCREEN_MAX_DIFFERENCE:
+            return None
+        return difference_map
+    
+    def get_working_size(self, size1, size2):
+        """Common (width, height) both images are processed at, capped by MAX_RESOLUTION"""
+        target_w = max(size1[0], size2[0])
+        target_h = max(size1[1], size2[1])
+        scale = min(1.0, MAX_RESOLUTION / max(target_w, target_h))
+        return max(1, round(target_w * scale)), max(1, round(target_h * scale))
+    
+    def resize_to(self, img, size):
+        h, w = img.shape[:2]
+        if (w, h) == tuple(size):
+            return img
+        # Area averaging is both faster and alias-free for large reductions
+        if size[0] <= w / 2 and size[1] <= h / 2:
+            interpolation = cv2.INTER_AREA
+        else:
+            interpolation = self.resize_method
+        return cv2.resize(img, tuple(size), interpolation=interpolation)
+    
+    def frame_at(self, image, size):
+        """ImageFrame of image at size; a frame already at that size keeps its precomputed views"""
+        if isinstance(image, ImageFrame):
+            if (image.shape[1], image.shape[0]) == tuple(size):
+                return image
+            image = image.bgr
+        return ImageFrame(self.resize_to(image, size))
+    
+    def resize_images_to_same_size(self, img1, img2, target_size=None, original_sizes=None):
+        if original_sizes is None:
+            original_sizes = ((img1.shape[1], img1.shape[0]), (img2.shape[1], img2.shape[0]))
+        if target_size is None:
+            target_size = self.get_working_size(*original_sizes)
+        img1_resized = self.resize_to(img1, target_size)
+        img2_resized = self.resize_to(img2, target_size)
+        logger.info(f"Images resized to: {target_size[0]}x{target_size[1]}")
         return img1_resized, img2_resized
     
+    def get_bounding_boxes(self, rects, working_size, original_size):
+        """(N, 4) x, y, width, height rects as boxes in working and original image2 coordinates"""
+        scale = np.float64([original_size[0], original_size[1]] * 2) / np.float64([working_size[0], working_size[1]] * 2)
+        originals = np.round(rects * scale).astype(np.int64).tolist()
+        return [{
+            'x': x, 'y': y, 'width': w, 'height': h,
+            'original': {'x': ox, 'y': oy, 'width': ow, 'height': oh}
+        } for (x, y, w, h), (ox, oy, ow, oh) in zip(rects.tolist(), originals)]
+    
+    def find_regions(self, thresh, diff, min_area=30):
+        """Connected components of a binary mask that pass the area and circularity filters.
+
+        Everything comes from one connectedComponentsWithStats pass and a few
+        whole-mask NumPy operations, so the cost does not grow with the
+        number of blobs. The filters measure the outline through the centres
+        of the boundary pixels, as contourArea and arcLength did on traced
+        contours: Pick's theorem gives its area from the pixel and boundary
+        pixel counts, and its length counts a step of 1 per boundary pixel
+        plus sqrt(2) - 1 per extra exposed pixel edge (a diagonal step).
+        Holes would count against a component there while an outer contour
+        encloses them, so the rejected components with room for a hole and
+        min_area are traced on their own to be judged as before. Shapes near
+        the circularity limit may still be judged differently. Returns a table
+        of arrays (rects, areas in pixels, centroids, mean_differences), in
+        raster order.
+        """
+        mask = thresh > 0
+        binary = mask.view(np.uint8)
+        # Each component holds at least one pixel, so sparse masks fit 16-bit labels, which halve the label
+        # writes; on dense masks BBDT (same labels as the default) keeps 32-bit labelling about as fast
+        ltype = cv2.CV_16U if cv2.countNonZero(binary) < np.iinfo(np.uint16).max else cv2.CV_32S
+        count, labels, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(
+            binary, 8, ltype, cv2.CCL_BBDT)
+        # 4 less the foreground 4-neighbours is the number of a pixel's edges facing the background or the
+        # border; pixels with any are the boundary pixels. One gather of the foreground feeds every sum.
+        neighbours = cv2.filter2D(binary, -1, FOUR_NEIGHBOURS, borderType=cv2.BORDER_CONSTANT)
+        foreground = np.flatnonzero(mask)
+        component = labels.ravel()[foreground]
+        exposed = 4 - neighbours.ravel()[foreground]
+        edges = np.bincount(component, weights=exposed, minlength=count)
+        boundary = np.bincount(component, weights=exposed > 0, minlength=count)
+        diff_sums = np.bincount(component, weights=diff.ravel()[foreground], minlength=count)
+        pixels = stats[:, cv2.CC_STAT_AREA]
+        outline_area = pixels - boundary / 2 - 1
+        perimeter = boundary + (np.sqrt(2) - 1) * (edges - boundary)
+        keep = (outline_area > min_area) & (4 * np.pi * outline_area > MIN_CIRCULARITY * perimeter ** 2)
+        keep[0] = False  # Background
+        # Filling holes only adds area and drops perimeter, so the estimates never wrongly keep a component;
+        # the few they reject that could enclose a hole are retraced on their bounding box
+        widths, heights = stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT]
+        retrace = ~keep & (widths > 2) & (heights > 2) & ((widths - 1) * (heights - 1) > min_area)
+        retrace[0] = False
+        for i in np.flatnonzero(retrace).tolist():
+            x, y, w, h = stats[i, :4].tolist()
+            outline = cv2.findContours((labels[y:y + h, x:x + w] == i).view(np.uint8), cv2.RETR_EXTERNAL,
+                                       cv2.CHAIN_APPROX_SIMPLE)[0][0]
+            area = cv2.contourArea(outline)
+            keep[i] = area > min_area and 4 * np.pi * area > MIN_CIRCULARITY * cv2.arcLength(outline, True) ** 2
+        ids = np.flatnonzero(keep)
+        return {
+            'rects': stats[ids, :4].astype(np.int32),
+            'areas': pixels[ids],
+            'centroids': centroids[ids],
+            'mean_differences': diff_sums[ids] / pixels[ids]
+        }
+    
+    def analyze_regions(self, regions):
+        """Region dicts of a find_regions() table, numbered from 1"""
+        return [{
+            'id': i + 1,
+            'x': x, 'y': y, 'width': w, 'height': h,
+            'area': area,
+            'centroid': centroid,
+            'mean_difference': mean_diff
+        } for i, ((x, y, w, h), area, centroid, mean_diff) in enumerate(zip(
+            regions['rects'].tolist(), regions['areas'].tolist(), np.round(regions['centroids'], 2).tolist(),
+            np.round(regions['mean_differences'], 2).tolist()))]
+    
     def create_superposition(self, img1, img2, alpha=0.5):
-        img1_float = img1.astype(np.float32)
-        img2_float = img2.astype(np.float32)
-        superposition = cv2.addWeighted(img1_float, alpha, img2_float, 1-alpha, 0)
-        superposition = np.clip(superposition, 0, 255).astype(np.uint8)
-        return superposition
+        # addWeighted saturates uint8 itself, no float copies needed
+        return cv2.addWeighted(img1, alpha, img2, 1 - alpha, 0)
     
-    def detect_differences_precise(self, img1, img2, sensitivity=25, min_area=30):
-        logger.info(f"Detection with threshold: {sensitivity}, min area: {min_area}")
-        gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
-        gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
-        gray1 = cv2.GaussianBlur(gray1, (3, 3), 0)
-        gray2 = cv2.GaussianBlur(gray2, (3, 3), 0)
-        diff = cv2.absdiff(gray1, gray2)
+    def detect_differences_precise(self, img1, img2, sensitivity=25, min_area=30, ssim_map=None):
+        frame1, frame2 = as_frame(img1), as_frame(img2)
+        diff = self.difference_map(frame1, frame2)
+        regions, thresh = self.threshold_differences(diff, sensitivity, min_area, ssim_map)
+        return regions, thresh, diff
+    
+    def is_tiled(self, shape):
+        return self.tile_size is not None and max(shape[:2]) > self.tile_size
+    
+    def run_tiles(self, fn, shape):
+        """Call fn(core, padded, inner) for every tile, on the tile threads"""
+        tiles = iter_tiles(shape[0], shape[1], self.tile_size)
+        for _ in tile_executor.map(lambda tile: fn(*tile), tiles):
+            pass
+    
+    def difference_map(self, frame1, frame2):
+        """absdiff of the blurred grayscale images, tile by tile when tile_size is set"""
+        if not self.is_tiled(frame1.shape):
+            return cv2.absdiff(frame1.blurred, frame2.blurred)
+        gray1, gray2 = frame1.gray, frame2.gray
+        diff = np.empty(gray1.shape, np.uint8)
+        def run(core, padded, inner):
+            blurred1 = cv2.GaussianBlur(gray1[padded], (3, 3), 0)
+            blurred2 = cv2.GaussianBlur(gray2[padded], (3, 3), 0)
+            diff[core] = cv2.absdiff(blurred1, blurred2)[inner]
+        self.run_tiles(run, diff.shape)
+        return diff
+    
+    def clean_mask(self, diff, sensitivity, low_ssim=None):
+        """Threshold an absdiff map and remove speckle with morphology"""
         _, thresh = cv2.threshold(diff, sensitivity, 255, cv2.THRESH_BINARY)
+        if low_ssim is not None:
+            thresh = cv2.bitwise_or(thresh, low_ssim)
         kernel = np.ones((3, 3), np.uint8)
         thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel, iterations=2)
         thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, iterations=1)
-        thresh = cv2.medianBlur(thresh, 5)
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        valid_contours = [c for c in contours if cv2.contourArea(c) > min_area and
-                         4 * np.pi * cv2.contourArea(c) / (cv2.arcLength(c, True) ** 2) > 0.1]
-        return valid_contours, thresh, diff
-    
-    def draw_differences_on_images(self, img1, img2, contours):
-        img1_marked = img1.copy()
-        img2_marked = img2.copy()
-        for i, contour in enumerate(contours):
-            x, y, w, h = cv2.boundingRect(contour)
-            cv2.rectangle(img1_marked, (x, y), (x + w, y + h), (0, 0, 255), 2)
-            cv2.rectangle(img2_marked, (x, y), (x + w, y + h), (0, 0, 255), 2)
-            cv2.putText(img1_marked, str(i+1), (x, y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
-            cv2.putText(img2_marked, str(i+1), (x, y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
-        return img1_marked, img2_marked
+        return cv2.medianBlur(thresh, 5)
+    
+    @timed('detect')
+    def threshold_differences(self, diff, sensitivity=25, min_area=30, ssim_map=None):
+        """Regions (see find_regions) and binary mask of the differences in an absdiff map.
+
+        In tiled mode each tile is cleaned with DETECTION_HALO pixels of
+        context, which makes the stitched mask identical to the full-frame
+        one; regions are then labelled on the stitched mask, so those that
+        cross tile edges come out whole.
+        """
+        logger.info(f"Detection with threshold: {sensitivity}, min area: {min_area}")
+        low_ssim = None
+        if ssim_map is not None and self.ssim_threshold is not None:
+            low_ssim = np.uint8(ssim_map < self.ssim_threshold) * 255
+            if low_ssim.shape != diff.shape:
+                low_ssim = cv2.resize(low_ssim, (diff.shape[1], diff.shape[0]), interpolation=cv2.INTER_NEAREST)
+        if self.is_tiled(diff.shape):
+            thresh = np.empty_like(diff)
+            def run(core, padded, inner):
+                tile_low_ssim = low_ssim[padded] if low_ssim is not None else None
+                thresh[core] = self.clean_mask(diff[padded], sensitivity, tile_low_ssim)[inner]
+            self.run_tiles(run, diff.shape)
+        else:
+            thresh = self.clean_mask(diff, sensitivity, low_ssim)
+        return self.find_regions(thresh, diff, min_area), thresh
+    
+    def annotate(self, image, rects, labelled=None):
+        """Copy of image with the (N, 4) rects drawn as red boxes, numbered from 1.
+
+        Only the indices in labelled (all by default) get their number: putText
+        is the one per-box call left, so a mask full of specks is bounded by it.
+        """
+        marked = image.copy()
+        x, y, w, h = rects.T
+        corners = np.stack([x, y, x + w, y, x + w, y + h, x, y + h], axis=1).reshape(-1, 4, 2).astype(np.int32)
+        # cv2.rectangle draws the same closed polyline; one call covers every box
+        cv2.polylines(marked, list(corners), True, (0, 0, 255), 2)
+        for i in (range(len(rects)) if labelled is None else labelled.tolist()):
+            cv2.putText(marked, str(i+1), (int(x[i]), int(y[i])-10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+        return marked
+    
+    def draw_differences_on_images(self, img1, img2, rects, areas=None):
+        """Both images marked with the rects; beyond MAX_LABELS boxes only the largest areas are numbered"""
+        labelled = None
+        if areas is not None and len(rects) > MAX_LABELS:
+            labelled = np.sort(np.argsort(areas, kind='stable')[::-1][:MAX_LABELS])
+        return self.annotate(img1, rects, labelled), self.annotate(img2, rects, labelled)
     
     def process_images_from_files(self, image1_path, image2_path, sensitivity=25, min_area=30, align=True):
-        logger.info("=== STARTING PROCESS WITH ALIGNMENT ===")
-        img1 = cv2.imread(image1_path)
-        img2 = cv2.imread(image2_path)
-        if img1 is None or img2 is None:
+        """process_images_from_buffers on the files' bytes, so files get the same reduced decode as uploads"""
+        try:
+            with open(image1_path, 'rb') as f1, open(image2_path, 'rb') as f2:
+                data1, data2 = f1.read(), f2.read()
+        except OSError:
             raise ValueError("Cannot load images. Check paths.")
+        return self.process_images_from_buffers(data1, data2, sensitivity, min_area, align)
+    
+    def process_images_from_buffers(self, data1, data2, sensitivity=25, min_area=30, align=True):
+        img1, size1 = decode_image_reduced(data1, MAX_RESOLUTION)
+        img2, size2 = decode_image_reduced(data2, MAX_RESOLUTION)
+        if img1 is None or img2 is None:
+            raise ValueError("Cannot decode images. Check file contents.")
+        return self.process_images_from_arrays(img1, img2, sensitivity, min_area, align,
+                                               original_sizes=(size1, size2))
+    
+    def process_images_from_arrays(self, img1, img2, sensitivity=25, min_area=30, align=True, original_sizes=None):
+        """Run the comparison on decoded BGR images.
+
+        original_sizes gives the (width, height) of each source image when the
+        arrays were decoded at reduced resolution; it defaults to the array sizes.
+        """
+        logger.info("=== STARTING PROCESS WITH ALIGNMENT ===")
         logger.info(f"Image 1: {img1.shape}")
         logger.info(f"Image 2: {img2.shape}")
-        img1_resized, img2_resized = self.resize_images_to_same_size(img1, img2)
+        pair, detection = self.detect_pair(img1, img2, sensitivity, min_area, align, original_sizes)
+        results = self.render_results(pair, detection['regions'], detection['threshold_map'])
+        logger.info(f"Similarity score: {results['similarity']:.3f}")
+        logger.info(f"Difference percentage: {results['difference_percentage']:.2f}%")
+        logger.info("=== PROCESS COMPLETE ===")
+        return results
+    
+    def detect_pair(self, img1, img2, sensitivity=25, min_area=30, align=True, original_sizes=None):
+        """Align and threshold a pair without drawing anything.
+
+        Returns (the aligned pair from align_pair, {'regions', 'threshold_map'}):
+        what render_results needs and what result_cache stores.
+        """
+        pair = self.align_pair(img1, img2, align, original_sizes)
+        alignment = pair['alignment'] or {}
+        if (alignment.get('skipped') == 'near_identical' and alignment['max_difference'] <= sensitivity
+                and self.ssim_threshold is None):
+            # Nothing exceeds the threshold: the mask is empty without running the morphology
+            thresh = np.zeros_like(pair['difference_map'])
+            regions = self.find_regions(thresh, pair['difference_map'], min_area)
+            pair.pop('ssim_map')
+        else:
+            regions, thresh = self.threshold_differences(pair['difference_map'], sensitivity, min_area,
+                                                         pair.pop('ssim_map'))
+        logger.info(f"Number of differences detected: {len(regions['rects'])}")
+        return pair, {'regions': regions, 'threshold_map': thresh}
+    
+    def align_pair(self, img1, img2, align=True, original_sizes=None):
+        """Resize, align and score a pair: the stages that do not depend on the thresholds.
+
+        Returns the aligned images, their absdiff map and SSIM score; ssim_map
+        is only computed when ssim_threshold is set. 'alignment' holds the
+        aligner's quality signal, or why alignment was skipped. Raises
+        AlignmentError when the quality is below ALIGNMENT_MIN_QUALITY.
+        """
+        if original_sizes is None:
+            original_sizes = ((img1.shape[1], img1.shape[0]), (img2.shape[1], img2.shape[0]))
+        working_size = self.get_working_size(*original_sizes)
+        with stage('resize'):
+            frame1, frame2 = self.frame_at(img1, working_size), self.frame_at(img2, working_size)
+        logger.info(f"Images resized to: {working_size[0]}x{working_size[1]}")
+        difference_map, alignment = None, None
         if align:
+            with stage('prescreen'):
+                difference_map = self.prescreen(frame1, frame2)
+        if difference_map is not None:
+            alignment = {'method': self.alignment_method, 'skipped': 'near_identical',
+                         'max_difference': int(difference_map.max())}
+            logger.info(f"3. No alignment needed (max difference {alignment['max_difference']})")
+        elif align:
             logger.info(f"3. Aligning images (method: {self.alignment_method})...")
-            img1_aligned, img2_aligned = self.align_images(img1_resized, img2_resized)
+            with stage(f'align_{self.alignment_method}'):
+                frame1, frame2 = self.align_images(frame1, frame2)
+            alignment = self.check_alignment()
+            # Only the aligners use the float, pyramid, spectrum and keypoint views
+            for frame in (frame1, frame2):
+                frame.release('gray_float', 'gray_pyramid', 'gray_float_pyramid', 'gray_spectrum', 'orb_features')
         else:
             logger.info("3. No alignment (disabled)")
-            img1_aligned, img2_aligned = img1_resized, img2_resized
-        superposition = self.create_superposition(img1_aligned, img2_aligned, alpha=0.5)
-        contours, thresh, diff = self.detect_differences_precise(img1_aligned, img2_aligned, sensitivity, min_area)
-        logger.info(f"Number of differences detected: {len(contours)}")
-        img1_marked, img2_marked = self.draw_differences_on_images(img1_aligned, img2_aligned, contours)
-        superposition_marked = self.create_superposition(img1_marked, img2_marked, alpha=0.5)
-        gray1 = cv2.cvtColor(img1_aligned, cv2.COLOR_BGR2GRAY)
-        gray2 = cv2.cvtColor(img2_aligned, cv2.COLOR_BGR2GRAY)
-        similarity = ssim(gray1, gray2)
-        total_pixels = gray1.shape[0] * gray1.shape[1]
-        diff_pixels = np.sum(thresh > 0)
+        # Tiled mode also scores SSIM in bands to bound its float32 buffers
+        tile_rows = self.tile_size if self.is_tiled(frame1.shape) else None
+        with stage('ssim'):
+            if self.ssim_threshold is not None:
+                similarity, ssim_map = structural_similarity(frame1.gray, frame2.gray, downsample=SSIM_DOWNSAMPLE,
+                                                             tile_rows=tile_rows, full=True)
+            else:
+                similarity = structural_similarity(frame1.gray, frame2.gray, downsample=SSIM_DOWNSAMPLE,
+                                                   tile_rows=tile_rows)
+                ssim_map = None
+        if difference_map is None:
+            with stage('detect'):
+                difference_map = self.difference_map(frame1, frame2)
+        return {
+            'img1_aligned': frame1.bgr,
+            'img2_aligned': frame2.bgr,
+            'difference_map': difference_map,
+            'similarity': similarity,
+            'ssim_map': ssim_map,
+            'working_size': working_size,
+            'original_size': original_sizes[1],
+            'alignment_method': self.alignment_method,
+            'alignment': alignment
+        }
+    
+    def render_results(self, pair, regions, thresh):
+        """Draw the find_regions() table on an aligned pair and collect the result images and metrics"""
+        img1_aligned, img2_aligned = pair['img1_aligned'], pair['img2_aligned']
+        rects = regions['rects']
+        with stage('detect'):
+            region_list = self.analyze_regions(regions)
+        with stage('draw'):
+            img1_marked, img2_marked = self.draw_differences_on_images(img1_aligned, img2_aligned, rects,
+                                                                       regions['areas'])
+        with stage('superposition'):
+            superposition = self.create_superposition(img1_aligned, img2_aligned, alpha=0.5)
+            superposition_marked = self.create_superposition(img1_marked, img2_marked, alpha=0.5)
+        total_pixels = thresh.shape[0] * thresh.shape[1]
+        diff_pixels = cv2.countNonZero(thresh)
         difference_percentage = (diff_pixels / total_pixels) * 100
-        logger.info(f"Similarity score: {similarity:.3f}")
-        logger.info(f"Difference percentage: {difference_percentage:.2f}%")
-        logger.info("=== PROCESS COMPLETE ===")
         return {
             'img1_original': img1_aligned,
             'img2_original': img2_aligned,
@@ -222,87 +1014,623 @@ class PreciseImageDifferenceDetector:
             'img2_marked': img2_marked,
             'superposition': superposition,
             'superposition_marked': superposition_marked,
-            'difference_map': diff,
+            'difference_map': pair['difference_map'],
             'threshold_map': thresh,
-            'num_differences': len(contours),
-            'similarity': similarity,
+            'num_differences': len(rects),
+            'similarity': pair['similarity'],
             'difference_percentage': difference_percentage,
-            'contours': contours,
-            'alignment_method': self.alignment_method
+            'bounding_boxes': self.get_bounding_boxes(rects, pair['working_size'], pair['original_size']),
+            'regions': region_list,
+            'working_size': pair['working_size'],
+            'original_size': pair['original_size'],
+            'alignment_method': pair['alignment_method'],
+            'alignment': pair.get('alignment')
         }
 
+def parse_comparison_options(form):
+    """Detection parameters from a request form, with the API defaults"""
+    ssim_threshold = form.get('ssim_threshold')
+    reference_id = form.get('reference_id') or None
+    if reference_id is not None and not is_reference_id(reference_id):
+        raise ValueError(f"Malformed reference_id {reference_id!r}")
+    alignment_method = form.get('alignment_method', 'phase')
+    if alignment_method not in ALIGNMENT_METHODS + ('auto',):
+        raise ValueError(f"alignment_method must be one of {', '.join(ALIGNMENT_METHODS + ('auto',))}")
+    return {
+        'sensitivity': int(form.get('sensitivity', 25)),
+        'min_area': int(form.get('min_area', 30)),
+        'align': form.get('align', 'true').lower() == 'true',
+        'alignment_method': alignment_method,
+        'ssim_threshold': float(ssim_threshold) if ssim_threshold else None,
+        'reference_id': reference_id
+    }
+
+reference_store = ReferenceStore(REFERENCES_FOLDER, REFERENCES_LOADED)
+
+def register_reference(data):
+    """Decode a reference image, precompute its alignment views and store them.
+
+    Returns (reference_id, index entry, created).
+    """
+    reference_id = reference_id_for(data)
+    if reference_store.exists(reference_id):
+        return reference_id, reference_store.get(reference_id), False
+    image, original_size = decode_image_reduced(data, MAX_RESOLUTION)
+    if image is None:
+        raise ValueError("Cannot decode image. Check file contents.")
+    detector = PreciseImageDifferenceDetector()
+    working_size = detector.get_working_size(original_size, original_size)
+    frame = detector.frame_at(image, working_size)
+    keypoints, descriptors = frame.orb_features
+    arrays = {
+        'bgr': frame.bgr,
+        'gray': frame.gray,
+        'keypoints': keypoints_to_array(keypoints),
+        'descriptors': descriptors if descriptors is not None else np.zeros((0, 32), np.uint8),
+        'spectrum': frame.gray_spectrum,
+        'original_size': np.int32(original_size)
+    }
+    entry = reference_store.save(reference_id, arrays, {
+        'original_size': list(original_size),
+        'working_size': list(working_size),
+        'num_keypoints': len(keypoints)
+    })
+    logger.info(f"Reference {reference_id} registered ({working_size[0]}x{working_size[1]}, "
+                f"{len(keypoints)} keypoints)")
+    return reference_id, entry, True
+
+def load_reference_frame(reference_id):
+    """(ImageFrame with the stored views, original (width, height)) of a registered reference"""
+    arrays = reference_store.load(reference_id)
+    descriptors = arrays['descriptors'] if len(arrays['descriptors']) else None
+    frame = ImageFrame.with_views(arrays['bgr'], gray=arrays['gray'], gray_spectrum=arrays['spectrum'],
+                                  orb_features=(keypoints_from_array(arrays['keypoints']), descriptors))
+    return frame, tuple(int(v) for v in arrays['original_size'])
+
+# References uploaded with a batch: reference_id -> number of running batches using it.
+# They are registered only for those batches and deleted when the last one ends.
+batch_references = {}
+batch_references_lock = threading.Lock()
+
+def acquire_batch_reference(data):
+    """Register a batch's reference upload for the duration of the batch; returns its reference_id"""
+    with batch_references_lock:
+        reference_id, _, created = register_reference(data)
+        if created or reference_id in batch_references:
+            batch_references[reference_id] = batch_references.get(reference_id, 0) + 1
+    return reference_id
+
+def release_batch_reference(reference_id):
+    """Delete a batch reference once no batch uses it, unless it was registered explicitly since"""
+    with batch_references_lock:
+        count = batch_references.pop(reference_id, 0)
+        if count > 1:
+            batch_references[reference_id] = count - 1
+        elif count == 1:
+            reference_store.delete(reference_id)
+
+def compare_buffers(data1, data2, options, profile=False):
+    """Align and threshold two encoded images; module-level so worker processes can run it.
+
+    Returns the result_cache tiers, {'alignment': pair, 'detection': ...},
+    with the stage timings under 'stages' for the caller to merge_trace()
+    and with profile the sampled stacks under 'profile'. Drawing and the
+    other result images are left to render_comparison() in the caller, so a
+    worker only sends back the aligned pair and the masks.
+    """
+    profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000) if profile else nullcontext()
+    with Trace(observe=False) as trace, profiler:
+        pair, detection = process_buffers(data1, data2, options)
+    comparison = {'alignment': pair, 'detection': detection, 'stages': trace.stages}
+    if profile:
+        comparison['profile'] = profiler.folded()
+    return comparison
+
+def process_buffers(data1, data2, options):
+    """Decode, align and threshold two uploads with the request's options; returns (pair, detection).
+
+    With options['reference_id'] set, data1 is ignored and the registered
+    reference is compared instead.
+    """
+    detector = PreciseImageDifferenceDetector()
+    detector.set_alignment_method(options['alignment_method'])
+    detector.ssim_threshold = options['ssim_threshold']
+    if options.get('reference_id'):
+        img1, size1 = load_reference_frame(options['reference_id'])
+    else:
+        img1, size1 = decode_image_reduced(data1, MAX_RESOLUTION)
+    img2, size2 = decode_image_reduced(data2, MAX_RESOLUTION)
+    if img1 is None or img2 is None:
+        raise ValueError("Cannot decode images. Check file contents.")
+    return detector.detect_pair(img1, img2, options['sensitivity'], options['min_area'], options['align'],
+                                original_sizes=(size1, size2))
+
+def render_comparison(comparison):
+    """Result images and metrics of a compare_buffers() result"""
+    detection = comparison['detection']
+    results = PreciseImageDifferenceDetector().render_results(comparison['alignment'], detection['regions'],
+                                                              detection['threshold_map'])
+    if 'profile' in comparison:
+        results['profile'] = comparison['profile']
+    return results
+
+result_cache = ResultCache(CACHE_MAX_MB * 1024 * 1024, os.path.join(RESULTS_FOLDER, 'cache'),
+                           CACHE_DISK_MAX_MB * 1024 * 1024)
+
+analysis_index = AnalysisIndex(RESULTS_FOLDER, RESULTS_TTL_HOURS * 3600, RESULTS_MAX_MB * 1024 * 1024)
+
+comparison_pool = None
+comparison_pool_lock = threading.Lock()
+
+def get_comparison_pool():
+    """The shared worker pool, created on first use; None when WORKER_PROCESSES is 0"""
+    global comparison_pool
+    if WORKER_PROCESSES <= 0:
+        return None
+    with comparison_pool_lock:
+        if comparison_pool is None:
+            comparison_pool = ComparisonPool(WORKER_PROCESSES, WORKER_QUEUE_DEPTH, WORKER_JOB_TIMEOUT)
+            logger.info(f"Worker pool started: {comparison_pool.stats()}")
+    return comparison_pool
+
+def comparison_cache_keys(data1, data2, options):
+    """(alignment key, detection key) of a comparison in result_cache"""
+    alignment_key = cache_key(upload_digest(data1, data2), align=options['align'],
+                              alignment_method=options['alignment_method'], reference_id=options['reference_id'])
+    # layout keeps detection entries that held contours (results/cache/ outlives upgrades) from being read back
+    detection_key = cache_key(alignment_key, sensitivity=options['sensitivity'], min_area=options['min_area'],
+                              ssim_threshold=options['ssim_threshold'], layout='regions')
+    return alignment_key, detection_key
+
+def compare_from_cache(alignment_key, detection_key, options):
+    """Results rebuilt from result_cache, or None if this pair was not aligned before.
+
+    With only the aligned pair cached, detection re-runs in this thread;
+    it is cheap next to decoding and alignment.
+    """
+    pair = result_cache.get('alignment', alignment_key)
+    if pair is None:
+        return None
+    detector = PreciseImageDifferenceDetector()
+    detection = result_cache.get('detection', detection_key)
+    if detection is None:
+        detector.ssim_threshold = options['ssim_threshold']
+        ssim_map = None
+        if detector.ssim_threshold is not None:
+            with stage('ssim'):
+                gray1 = cv2.cvtColor(pair['img1_aligned'], cv2.COLOR_BGR2GRAY)
+                gray2 = cv2.cvtColor(pair['img2_aligned'], cv2.COLOR_BGR2GRAY)
+                _, ssim_map = structural_similarity(gray1, gray2, downsample=SSIM_DOWNSAMPLE, full=True)
+        regions, thresh = detector.threshold_differences(pair['difference_map'], options['sensitivity'],
+                                                         options['min_area'], ssim_map)
+        detection = {'regions': regions, 'threshold_map': thresh}
+        result_cache.put('detection', detection_key, detection)
+        logger.info("Cache hit for the aligned pair, detection re-run")
+    else:
+        logger.info("Cache hit for the detection results")
+    return detector.render_results(pair, detection['regions'], detection['threshold_map'])
+
+def cache_results(alignment_key, detection_key, comparison):
+    result_cache.put('alignment', alignment_key, comparison['alignment'])
+    result_cache.put('detection', detection_key, comparison['detection'])
+
+def run_comparison(data1, data2, options, profile=False):
+    """Compare in the worker pool when one is configured, otherwise in this thread.
+
+    Pairs seen before are served from result_cache instead, unless profile
+    asks for a profiled run (its stacks are returned under 'profile').
+    """
+    alignment_key, detection_key = comparison_cache_keys(data1, data2, options)
+    if not profile:
+        results = compare_from_cache(alignment_key, detection_key, options)
+        if results is not None:
+            return results
+    pool = get_comparison_pool()
+    if pool is None:
+        comparison = compare_buffers(data1, data2, options, profile)
+    else:
+        comparison = pool.run(compare_buffers, bytes(data1), bytes(data2), options, profile)
+    merge_trace(comparison.pop('stages', None))
+    cache_results(alignment_key, detection_key, comparison)
+    return render_comparison(comparison)
+
+def results_metrics(results):
+    """JSON-safe metrics of a comparison, as returned by the API"""
+    return {
+        'num_differences': results['num_differences'],
+        'similarity': float(results['similarity']),
+        'difference_percentage': float(results['difference_percentage']),
+        'bounding_boxes': results['bounding_boxes'],
+        'regions': results['regions'],
+        'working_size': list(results['working_size']),
+        'original_size': list(results['original_size']),
+        'alignment_method': results['alignment_method'],
+        'alignment': results['alignment']
+    }
+
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_THREADS, thread_name_prefix='batch')
+
+def compare_batch_items(candidates, options):
+    """Compare each candidate buffer against options['reference_id'].
+
+    Yields (index, results or exception) as comparisons finish; results
+    carry their stage timings under 'stages'. Cached pairs
+    come first; the rest run in the worker pool (or on batch threads without
+    one), at most one per worker at a time so a batch leaves room in the
+    pool's queue for other requests.
+    """
+    pool = get_comparison_pool()
+    submit = pool.submit if pool is not None else batch_executor.submit
+    max_in_flight = pool.workers if pool is not None else BATCH_THREADS
+    queue = []
+    for index, data in enumerate(candidates):
+        keys = comparison_cache_keys(b'', data, options)
+        try:
+            with Trace(observe=False) as trace:
+                results = compare_from_cache(*keys, options)
+            if results is not None:
+                results['stages'] = trace.stages
+        except Exception as e:
+            results = e
+        if results is not None:
+            yield index, results
+        else:
+            queue.append((index, data, keys))
+    
+    queue.reverse()
+    running = {}
+    retried = set()
+    busy_since = None
+    while queue or running:
+        while queue and len(running) < max_in_flight:
+            index, data, keys = queue[-1]
+            try:
+                future = submit(compare_buffers, b'', bytes(data), options)
+            except PoolBusyError as e:
+                # Other requests hold every slot; wait for them unless we hold some
+                if running:
+                    break
+                busy_since = busy_since or time.monotonic()
+                if time.monotonic() - busy_since > WORKER_JOB_TIMEOUT:
+                    queue.pop()
+                    yield index, e
+                else:
+                    time.sleep(0.5)
+                continue
+            busy_since = None
+            queue.pop()
+            running[future] = (index, data, keys)
+        if not running:
+            continue
+        done, _ = wait(running, timeout=WORKER_JOB_TIMEOUT, return_when=FIRST_COMPLETED)
+        if not done:
+            for future, (index, _, _) in running.items():
+                future.cancel()
+                if pool is not None:
+                    # The stuck jobs hold their workers until the processes are replaced
+                    pool.restart(future.executor, f"Batch job exceeded {WORKER_JOB_TIMEOUT:.0f}s")
+                yield index, JobTimeoutError(f"Comparison exceeded {WORKER_JOB_TIMEOUT:.0f}s")
+            running.clear()
+        for future in done:
+            index, data, keys = running.pop(future)
+            try:
+                comparison = future.result()
+                cache_results(*keys, comparison)
+                with Trace(observe=False) as trace:
+                    merge_trace(comparison.pop('stages'))
+                    results = render_comparison(comparison)
+                results['stages'] = trace.stages
+            except (BrokenProcessPool, CancelledError) as e:
+                if not pool.restart(future.executor) and index not in retried:
+                    # Lost to another job's restart: run it again on the new workers
+                    retried.add(index)
+                    queue.append((index, data, keys))
+                    continue
+                results = e
+            except Exception as e:
+                results = e
+            yield index, results
+
+def parse_response_options(form, headers):
+    """How /compare_images should return its results.
+
+    response_mode: full (base64 images in JSON, the default), metrics (no
+    images), urls (links to the saved artifacts) or multipart (JSON plus raw
+    JPEG parts; also chosen by Accept: multipart/mixed). images restricts
+    which images are returned and max_dimension caps their longest side.
+    timings adds the per-stage breakdown of the request; profile samples the
+    comparison and saves its stacks under PROFILE_FOLDER.
+    """
+    mode = form.get('response_mode')
+    if not mode:
+        mode = 'multipart' if 'multipart/mixed' in headers.get('Accept', '') else 'full'
+    if mode not in RESPONSE_MODES:
+        raise ValueError(f"response_mode must be one of {', '.join(RESPONSE_MODES)}")
+    images = [name.strip() for name in form.get('images', '').split(',') if name.strip()]
+    unknown = set(images) - set(RESPONSE_IMAGES)
+    if unknown:
+        raise ValueError(f"Unknown images: {', '.join(sorted(unknown))}")
+    max_dimension = parse_max_dimension(form.get('max_dimension'))
+    profile = form.get('profile', 'false').lower() == 'true'
+    if profile and not PROFILE_FOLDER:
+        raise ValueError("profile needs the server's PROFILE_FOLDER to be set")
+    return {
+        'mode': mode,
+        'images': images or list(RESPONSE_IMAGES),
+        'max_dimension': max_dimension,
+        'timings': form.get('timings', 'false').lower() == 'true',
+        'profile': profile
+    }
+
+def parse_max_dimension(value):
+    """A positive pixel count from a request parameter, or None when absent"""
+    if value is None or value == '':
+        return None
+    max_dimension = int(value)
+    if max_dimension <= 0:
+        raise ValueError(f"max_dimension must be positive, got {max_dimension}")
+    return max_dimension
+
+def limit_size(image, max_dimension):
+    """Downscale so the longest side is at most max_dimension"""
+    h, w = image.shape[:2]
+    if not max_dimension or max(h, w) <= max_dimension:
+        return image
+    scale = max_dimension / max(h, w)
+    return cv2.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+@timed('encode')
+def encode_jpeg(image, quality=85, max_dimension=None):
+    _, buffer = cv2.imencode('.jpg', limit_size(image, max_dimension), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer
+
 def image_to_base64(image, quality=85):
     """Convert image to base64 with compression"""
-    _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
-    return base64.b64encode(buffer).decode('utf-8')
+    return base64.b64encode(encode_jpeg(image, quality)).decode('utf-8')
+
+def build_multipart_response(metadata, images):
+    """multipart/mixed body: the JSON metadata part followed by one raw JPEG part per image"""
+    boundary = uuid.uuid4().hex
+    parts = [
+        f'--{boundary}\r\nContent-Type: application/json\r\n'
+        f'Content-Disposition: inline; name="metadata"\r\n\r\n'.encode('ascii'),
+        app.json.dumps(metadata).encode('utf-8'),
+        b'\r\n'
+    ]
+    for name, buffer in images.items():
+        parts.append(f'--{boundary}\r\nContent-Type: image/jpeg\r\n'
+                     f'Content-Disposition: inline; name="{name}"; filename="{name}.jpg"\r\n\r\n'.encode('ascii'))
+        parts.append(buffer.tobytes())
+        parts.append(b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode('ascii'))
+    return app.response_class(b''.join(parts), content_type=f'multipart/mixed; boundary={boundary}')
 
-def save_result_images(analysis_id, results):
-    """Save result images to the results folder"""
+def parse_persist_selection(value):
+    """Artifact names to save, from a comma list or 'all'/'none'"""
+    value = (value or '').strip().lower()
+    if value == 'all':
+        return list(ARTIFACTS)
+    if value in ('none', ''):
+        return []
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = set(names) - set(ARTIFACTS)
+    if unknown:
+        raise ValueError(f"Unknown artifacts: {', '.join(sorted(unknown))}")
+    return names
+
+DEFAULT_PERSIST_ARTIFACTS = parse_persist_selection(PERSIST_ARTIFACTS)
+
+encode_executor = ThreadPoolExecutor(max_workers=PERSIST_THREADS, thread_name_prefix='encode')
+persist_executor = ThreadPoolExecutor(max_workers=PERSIST_THREADS, thread_name_prefix='persist')
+pending_persistence = {}
+pending_persistence_lock = threading.Lock()
+
+def encode_artifacts(results, names, response_images=(), max_dimension=None):
+    """Encode the named artifacts and response images in parallel (imencode releases the GIL).
+
+    Returns (artifacts, response images). A response image shares the
+    artifact's bytes unless the artifact is not persisted or max_dimension
+    shrinks the response copy.
+    """
+    jobs = [(name, ARTIFACTS[name]) for name in names]
+    shared = {}
+    for name in response_images:
+        artifact = RESPONSE_IMAGES[name]
+        if artifact in names and not max_dimension:
+            shared[name] = artifact
+        else:
+            jobs.append((name, ARTIFACTS[artifact]))
+    def encode(job):
+        start = time.thread_time()
+        name, (key, ext, params) = job
+        image = results[key] if name in ARTIFACTS else limit_size(results[key], max_dimension)
+        ok, buffer = cv2.imencode(ext, image, params)
+        if not ok:
+            raise ValueError(f"Cannot encode {name}")
+        return name, buffer, time.thread_time() - start
+    with stage('encode') as encoding:
+        encoded = {}
+        for name, buffer, cpu in encode_executor.map(encode, jobs):
+            encoded[name] = buffer
+            encoding.add_cpu(cpu)
+    artifacts = {name: encoded[name] for name in names}
+    images = {name: encoded[shared[name]] if name in shared else encoded[name] for name in response_images}
+    return artifacts, images
+
+def get_artifact_path(analysis_id, name):
+    return os.path.join(app.config['RESULTS_FOLDER'], analysis_id, name + ARTIFACTS[name][1])
+
+def build_summary(analysis_id, results, options, names):
+    return {
+        'analysis_id': analysis_id,
+        'timestamp': datetime.now().isoformat(),
+        'num_differences': results['num_differences'],
+        'similarity': float(results['similarity']),
+        'difference_percentage': float(results['difference_percentage']),
+        'alignment_method': results['alignment_method'],
+        'alignment': results['alignment'],
+        'working_size': list(results['working_size']),
+        'original_size': list(results['original_size']),
+        'bounding_boxes': results['bounding_boxes'],
+        'regions': results['regions'],
+        'parameters': options,
+        'saved_files': {name: get_artifact_path(analysis_id, name) for name in names}
+    }
+
+@timed('persist')
+def write_artifacts(analysis_id, encoded, summary):
+    """Write encoded artifacts, then the summary, under results/<analysis_id>/ and index the analysis"""
     results_dir = os.path.join(app.config['RESULTS_FOLDER'], analysis_id)
     os.makedirs(results_dir, exist_ok=True)
+    for name, buffer in encoded.items():
+        with open(get_artifact_path(analysis_id, name), 'wb') as f:
+            f.write(buffer)
     
-    saved_files = {}
-    
+    # Written last and atomically: its presence marks the analysis as complete
+    summary_path = get_summary_path(analysis_id)
+    summary_text = json.dumps(summary, indent=2)
+    with open(summary_path + '.tmp', 'w') as f:
+        f.write(summary_text)
+    os.replace(summary_path + '.tmp', summary_path)
     try:
-        # Save original aligned images
-        img1_path = os.path.join(results_dir, 'image1_original.jpg')
-        img2_path = os.path.join(results_dir, 'image2_original.jpg')
-        cv2.imwrite(img1_path, results['img1_original'])
-        cv2.imwrite(img2_path, results['img2_original'])
-        saved_files['image1_original'] = img1_path
-        saved_files['image2_original'] = img2_path
-        
-        # Save marked images (with difference rectangles)
-        img1_marked_path = os.path.join(results_dir, 'image1_marked.jpg')
-        img2_marked_path = os.path.join(results_dir, 'image2_marked.jpg')
-        cv2.imwrite(img1_marked_path, results['img1_marked'])
-        cv2.imwrite(img2_marked_path, results['img2_marked'])
-        saved_files['image1_marked'] = img1_marked_path
-        saved_files['image2_marked'] = img2_marked_path
-        
-        # Save superposition images
-        superposition_path = os.path.join(results_dir, 'superposition.jpg')
-        superposition_marked_path = os.path.join(results_dir, 'superposition_marked.jpg')
-        cv2.imwrite(superposition_path, results['superposition'])
-        cv2.imwrite(superposition_marked_path, results['superposition_marked'])
-        saved_files['superposition'] = superposition_path
-        saved_files['superposition_marked'] = superposition_marked_path
-        
-        # Save difference maps
-        diff_map_path = os.path.join(results_dir, 'difference_map.jpg')
-        threshold_map_path = os.path.join(results_dir, 'threshold_map.jpg')
-        cv2.imwrite(diff_map_path, results['difference_map'])
-        cv2.imwrite(threshold_map_path, results['threshold_map'])
-        saved_files['difference_map'] = diff_map_path
-        saved_files['threshold_map'] = threshold_map_path
-        
-        # Save analysis summary as JSON
-        summary_path = os.path.join(results_dir, 'analysis_summary.json')
-        import json
-        summary = {
-            'analysis_id': analysis_id,
-            'timestamp': datetime.now().isoformat(),
-            'num_differences': results['num_differences'],
-            'similarity': float(results['similarity']),
-            'difference_percentage': float(results['difference_percentage']),
-            'alignment_method': results['alignment_method'],
-            'saved_files': saved_files
-        }
-        with open(summary_path, 'w') as f:
-            json.dump(summary, f, indent=2)
-        saved_files['analysis_summary'] = summary_path
-        
-        logger.info(f"Results saved to: {results_dir}")
-        return saved_files
-        
+        analysis_index.add(analysis_id, summary, sum(len(buffer) for buffer in encoded.values()) + len(summary_text))
+    except sqlite3.Error as e:
+        # The next startup reconciliation indexes it
+        logger.warning(f"Cannot index analysis {analysis_id}: {e}")
+    logger.info(f"Results saved to: {results_dir} ({len(encoded)} artifacts)")
+    return {**summary['saved_files'], 'analysis_summary': summary_path}
+
+def save_result_images(analysis_id, results, options=None, names=None):
+    """Encode and save result images to the results folder"""
+    names = DEFAULT_PERSIST_ARTIFACTS if names is None else names
+    try:
+        encoded, _ = encode_artifacts(results, names)
+        return write_artifacts(analysis_id, encoded, build_summary(analysis_id, results, options, names))
     except Exception as e:
         logger.error(f"Error saving results: {e}")
         return {}
 
+def persist_in_background(analysis_id, encoded, summary):
+    """Queue write_artifacts on the persistence threads; returns the paths that will be written"""
+    def persist():
+        try:
+            write_artifacts(analysis_id, encoded, summary)
+        except Exception as e:
+            logger.error(f"Error saving results for {analysis_id}: {e}")
+        finally:
+            with pending_persistence_lock:
+                pending_persistence.pop(analysis_id, None)
+    with pending_persistence_lock:
+        pending_persistence[analysis_id] = persist_executor.submit(persist)
+    return {**summary['saved_files'], 'analysis_summary': get_summary_path(analysis_id)}
+
+def wait_for_persistence(analysis_id, timeout=30):
+    """Block until a background write for analysis_id (if any) has finished"""
+    with pending_persistence_lock:
+        future = pending_persistence.get(analysis_id)
+    if future is not None:
+        future.result(timeout=timeout)
+
+def save_profile(analysis_id, folded):
+    """Write collapsed profiler stacks to PROFILE_FOLDER/<analysis_id>.folded"""
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    path = os.path.join(PROFILE_FOLDER, analysis_id + '.folded')
+    with open(path, 'w') as f:
+        f.write(folded)
+    logger.info(f"Profile saved to: {path}")
+    return path
+
+def start_maintenance():
+    """Reconcile results/ with its index, clear stale uploads and start background eviction.
+
+    Called by the server entry points rather than on import, since worker
+    processes import this module too.
+    """
+    added, forgotten, removed = analysis_index.reconcile(ORPHAN_GRACE_SECONDS)
+    # Uploads are no longer written to disk; files and uploads/<analysis_id>/ folders left there are orphans
+    stale_uploads = remove_stale_entries(UPLOAD_FOLDER, ORPHAN_GRACE_SECONDS)
+    logger.info(f"Results reconciled: {added} indexed, {forgotten} missing forgotten, {removed} incomplete "
+                f"removed, {stale_uploads} stale uploads removed")
+    analysis_index.evict()
+    analysis_index.start(RESULTS_EVICTION_INTERVAL)
+
+def get_summary_path(analysis_id):
+    return os.path.join(app.config['RESULTS_FOLDER'], analysis_id, 'analysis_summary.json')
+
+def load_analysis_summary(analysis_id):
+    """The saved summary of a finished analysis, or None"""
+    wait_for_persistence(analysis_id)
+    try:
+        with open(get_summary_path(analysis_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def run_job(analysis_id, data1, data2, options, persist):
+    """Body of a background job: compare, then persist under results/<analysis_id>/"""
+    deadline = time.monotonic() + WORKER_JOB_TIMEOUT
+    with Trace():
+        while True:
+            try:
+                results = run_comparison(data1, data2, options)
+                break
+            except AlignmentError as e:
+                # The same pair would fail again, so resubmissions get this outcome instead of a rerun
+                raise JobRejectedError(str(e), 'unalignable', alignment=e.quality)
+            except PoolBusyError:
+                # Synchronous requests filled the pool; wait for a slot
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(1)
+        if not save_result_images(analysis_id, results, options, persist):
+            raise RuntimeError("Could not save results")
+
+job_manager = JobManager(JOB_THREADS, JOB_MAX_PENDING,
+                         lambda analysis_id: os.path.exists(get_summary_path(analysis_id)))
+
 def allowed_file(filename):
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def validate_image_uploads(files, names=('image1', 'image2')):
+    """Error response for a missing/invalid upload among names, or None if all are fine"""
+    if any(name not in files for name in names):
+        logger.error("Missing image files")
+        return jsonify({
+            'success': False,
+            'error': 'Both image1 and image2 files are required' if len(names) == 2 else f'{names[0]} file is required',
+            'details': 'Ensure both files are uploaded' if len(names) == 2 else 'Ensure the file is uploaded'
+        }), 400
+    
+    if any(files[name].filename == '' for name in names):
+        logger.error("Empty filenames")
+        return jsonify({
+            'success': False,
+            'error': 'Both files must have valid filenames' if len(names) == 2 else 'File must have a valid filename',
+            'details': 'Check file names'
+        }), 400
+    
+    if not all(allowed_file(files[name].filename) for name in names):
+        logger.error("Invalid file types")
+        return jsonify({
+            'success': False,
+            'error': 'Invalid file type. Allowed types: png, jpg, jpeg, gif, bmp, tiff',
+            'details': 'Upload supported image formats'
+        }), 400
+    
+    return None
+
+def comparison_uploads():
+    """Upload fields a comparison needs: image2 alone when a reference_id replaces image1"""
+    return ('image2',) if request.form.get('reference_id') else ('image1', 'image2')
+
+def unknown_reference_response(reference_id):
+    return jsonify({
+        'success': False,
+        'error': f'Unknown reference_id {reference_id}',
+        'details': 'Register the reference with POST /references first'
+    }), 404
+
 @app.route('/')
 def index():
     return jsonify({
@@ -311,107 +1639,156 @@ def index():
         'status': 'running',
         'endpoints': {
             'POST /compare_images': 'Compare two images and detect differences',
-            'GET /health': 'Health check endpoint'
+            'POST /compare_batch': 'Compare one reference with many images, streaming NDJSON results',
+            'POST /jobs': 'Submit a comparison to run in the background',
+            'GET /jobs/<analysis_id>': 'Status and metrics of a job',
+            'GET /jobs/<analysis_id>/artifacts/<name>': 'Download one result image of a finished job',
+            'POST /references': 'Register a reference image to compare against by reference_id',
+            'GET /references': 'List registered reference images',
+            'DELETE /references/<reference_id>': 'Remove a registered reference image',
+            'GET /health': 'Health check endpoint',
+            'GET /metrics': 'Per-stage timing histograms in Prometheus text format',
+            'GET /analyses': 'List persisted analyses, newest first'
         }
     })
 
 @app.route('/health')
 def health():
+    pool = get_comparison_pool()
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'service': 'EXTNOT Image Comparison API'
+        'service': 'EXTNOT Image Comparison API',
+        'worker_pool': pool.stats() if pool is not None else None,
+        'jobs': job_manager.stats(),
+        'cache': result_cache.stats(),
+        'analyses': analysis_index.stats()
     })
 
+@app.route('/metrics')
+def prometheus_metrics():
+    return app.response_class(stage_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/compare_images', methods=['POST'])
 @require_api_key
+@traced
 def compare_images():
     try:
         logger.info(f"Request: POST /compare_images from {request.remote_addr}")
-        if 'image1' not in request.files or 'image2' not in request.files:
-            logger.error("Missing image files")
-            return jsonify({
-                'success': False,
-                'error': 'Both image1 and image2 files are required',
-                'details': 'Ensure both files are uploaded'
-            }), 400
+        error_response = validate_image_uploads(request.files, comparison_uploads())
+        if error_response is not None:
+            return error_response
         
-        image1_file = request.files['image1']
         image2_file = request.files['image2']
         
-        if image1_file.filename == '' or image2_file.filename == '':
-            logger.error("Empty filenames")
-            return jsonify({
-                'success': False,
-                'error': 'Both files must have valid filenames',
-                'details': 'Check file names'
-            }), 400
-        
-        if not (allowed_file(image1_file.filename) and allowed_file(image2_file.filename)):
-            logger.error("Invalid file types")
-            return jsonify({
-                'success': False,
-                'error': 'Invalid file type. Allowed types: png, jpg, jpeg, gif, bmp, tiff',
-                'details': 'Upload supported image formats'
-            }), 400
-        
         analysis_id = str(uuid.uuid4())
         logger.info(f"Analysis ID: {analysis_id}")
-        temp_dir = os.path.join(app.config['UPLOAD_FOLDER'], analysis_id)
-        os.makedirs(temp_dir, exist_ok=True)
         
         try:
-            image1_path = os.path.join(temp_dir, secure_filename(image1_file.filename))
-            image2_path = os.path.join(temp_dir, secure_filename(image2_file.filename))
-            image1_file.save(image1_path)
-            image2_file.save(image2_path)
-            logger.info(f"Images saved: {image1_path}, {image2_path}")
+            if not request.form.get('reference_id'):
+                image1_file = request.files['image1']
+                image1_data = read_upload(image1_file)
+                image1_name = image1_file.filename
+            else:
+                image1_data, image1_name = b'', f"reference {request.form['reference_id']}"
+            image2_data = read_upload(image2_file)
+            logger.info(f"Images received: {image1_name} ({len(image1_data)} bytes), "
+                        f"{image2_file.filename} ({len(image2_data)} bytes)")
             
-            sensitivity = int(request.form.get('sensitivity', 25))
-            min_area = int(request.form.get('min_area', 30))
-            align = request.form.get('align', 'true').lower() == 'true'
-            alignment_method = request.form.get('alignment_method', 'phase')
-            logger.info(f"Parameters: sensitivity={sensitivity}, min_area={min_area}, align={align}, method={alignment_method}")
+            try:
+                options = parse_comparison_options(request.form)
+                response_options = parse_response_options(request.form, request.headers)
+                persist = request.form.get('persist')
+                persist = DEFAULT_PERSIST_ARTIFACTS if persist is None else parse_persist_selection(persist)
+            except ValueError as e:
+                return jsonify({
+                    'success': False,
+                    'error': f'Invalid parameter: {e}',
+                    'details': 'Check sensitivity, min_area, alignment_method, response_mode, images, max_dimension, persist and profile'
+                }), 400
+            if options['reference_id'] and not reference_store.exists(options['reference_id']):
+                return unknown_reference_response(options['reference_id'])
+            logger.info(f"Parameters: sensitivity={options['sensitivity']}, min_area={options['min_area']}, "
+                        f"align={options['align']}, method={options['alignment_method']}, "
+                        f"response={response_options['mode']}")
             
-            detector = PreciseImageDifferenceDetector()
-            detector.set_alignment_method(alignment_method)
-            results = detector.process_images_from_files(image1_path, image2_path, sensitivity, min_area, align)
+            results = run_comparison(image1_data, image2_data, options, response_options['profile'])
+            profile = results.pop('profile', None)
+            
+            mode = response_options['mode']
+            if mode == 'urls':
+                # Linked artifacts must exist on disk
+                persist = list(dict.fromkeys(persist + [RESPONSE_IMAGES[name] for name in response_options['images']]))
+            encoded, images = encode_artifacts(results, persist,
+                                               response_options['images'] if mode in ('full', 'multipart') else (),
+                                               response_options['max_dimension'])
             
             # NOUVEAU: Sauvegarder les résultats dans le dossier results
-            saved_files = save_result_images(analysis_id, results)
+            # Disk writes run on background threads while the response is sent
+            summary = build_summary(analysis_id, results, options, persist)
+            saved_files = persist_in_background(analysis_id, encoded, summary)
             
-            # Return response with base64 images and file paths
             response_data = {
                 'success': True,
                 'analysis_id': analysis_id,
                 'timestamp': datetime.now().isoformat(),
-                'results': {
-                    'original_image1': image_to_base64(results['img1_original'], quality=75),
-                    'original_image2': image_to_base64(results['img2_original'], quality=75),
-                    'difference_image': image_to_base64(results['superposition_marked'], quality=80),
-                    'num_differences': results['num_differences'],
-                    'similarity': float(results['similarity']),
-                    'difference_percentage': float(results['difference_percentage']),
-                    'alignment_method': results['alignment_method']
-                },
+                'results': results_metrics(results),
                 'saved_files': saved_files,  # NOUVEAU: Chemins des fichiers sauvegardés
-                'parameters': {
-                    'sensitivity': sensitivity,
-                    'min_area': min_area,
-                    'align': align,
-                    'alignment_method': alignment_method
-                }
+                'parameters': options
             }
             
-            # Log response size
-            import json
-            response_size = len(json.dumps(response_data)) / (1024 * 1024)
-            logger.info(f"Response size: {response_size:.2f} MB")
+            if mode == 'urls':
+                response_data['artifacts'] = {
+                    name: url_for('get_job_artifact', analysis_id=analysis_id, name=RESPONSE_IMAGES[name],
+                                  max_dimension=response_options['max_dimension'])
+                    for name in response_options['images']
+                }
+            
+            if profile is not None:
+                response_data['profile'] = save_profile(analysis_id, profile)
+            if response_options['timings']:
+                response_data['timings'] = g.trace.breakdown()
+            
+            if mode == 'multipart':
+                response = build_multipart_response(response_data, images)
+            else:
+                for name, buffer in images.items():
+                    response_data['results'][name] = base64.b64encode(buffer).decode('ascii')
+                response = app.response_class(app.json.dumps(response_data), mimetype='application/json')
+            
+            logger.info(f"Response size: {response.content_length / (1024 * 1024):.2f} MB ({mode})")
             logger.info(f"Files saved: {len(saved_files)} files")
             
             logger.info("Image comparison completed successfully")
-            return jsonify(response_data)
+            return response
             
+        except PoolBusyError as e:
+            logger.warning(f"Rejecting comparison: {e}")
+            return jsonify({
+                'success': False,
+                'error': 'Server busy, retry later',
+                'details': str(e)
+            }), 503, {'Retry-After': str(RETRY_AFTER_SECONDS)}
+        
+        except AlignmentError as e:
+            logger.warning(f"Rejecting comparison: {e}")
+            return jsonify({
+                'success': False,
+                'status': 'unalignable',
+                'error': str(e),
+                'alignment': e.quality,
+                'details': 'Retake the image closer to the reference framing, try another alignment_method '
+                           'or send align=false'
+            }), 422
+        
+        except JobTimeoutError as e:
+            logger.error(f"Comparison timed out: {e}")
+            return jsonify({
+                'success': False,
+                'error': str(e),
+                'details': 'Try smaller images or a faster alignment method'
+            }), 504
+        
         except Exception as e:
             logger.error(f"Error processing images: {e}")
             return jsonify({
@@ -419,14 +1796,6 @@ def compare_images():
                 'error': str(e),
                 'details': 'Check image format, size, or server status'
             }), 500
-            
-        finally:
-            try:
-                if os.path.exists(temp_dir):
-                    shutil.rmtree(temp_dir)
-                    logger.info(f"Cleaned up temporary directory: {temp_dir}")
-            except Exception as e:
-                logger.error(f"Error cleaning up temporary files: {e}")
     
     except Exception as e:
         logger.error(f"Unexpected error in compare_images: {e}")
@@ -436,6 +1805,284 @@ def compare_images():
             'details': 'Contact administrator if issue persists'
         }), 500
 
+@app.route('/compare_batch', methods=['POST'])
+@require_api_key
+def compare_batch():
+    """Compare one reference with many candidates, streaming one NDJSON line per result"""
+    request.max_content_length = BATCH_MAX_CONTENT_LENGTH
+    candidates = request.files.getlist('candidates')
+    if not candidates or not (request.form.get('reference_id') or 'reference' in request.files):
+        return jsonify({
+            'success': False,
+            'error': 'A reference (file or reference_id) and at least one candidates file are required',
+            'details': 'Upload the reference as "reference" and each image to check as "candidates"'
+        }), 400
+    if len(candidates) > BATCH_MAX_ITEMS:
+        return jsonify({
+            'success': False,
+            'error': f'Too many candidates ({len(candidates)})',
+            'details': f'At most {BATCH_MAX_ITEMS} candidates per batch'
+        }), 400
+    if not all(allowed_file(f.filename) for f in candidates + request.files.getlist('reference')):
+        return jsonify({
+            'success': False,
+            'error': 'Invalid file type. Allowed types: png, jpg, jpeg, gif, bmp, tiff',
+            'details': 'Upload supported image formats'
+        }), 400
+    
+    try:
+        options = parse_comparison_options(request.form)
+        persist = request.form.get('persist')
+        persist = DEFAULT_PERSIST_ARTIFACTS if persist is None else parse_persist_selection(persist)
+        # An uploaded reference is preprocessed once for the whole batch and deleted after it
+        uploaded_reference = 'reference' in request.files
+        if uploaded_reference:
+            options['reference_id'] = acquire_batch_reference(read_upload(request.files['reference']))
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': f'Invalid parameter: {e}',
+            'details': 'Check the reference image, sensitivity, min_area, alignment_method, ssim_threshold and persist'
+        }), 400
+    if not uploaded_reference and not reference_store.exists(options['reference_id']):
+        return unknown_reference_response(options['reference_id'])
+    
+    filenames = [f.filename for f in candidates]
+    buffers = [read_upload(f) for f in candidates]
+    logger.info(f"Batch: {len(buffers)} candidates against reference {options['reference_id']}")
+    
+    def generate():
+        ranking = []
+        for index, results in compare_batch_items(buffers, options):
+            if isinstance(results, Exception):
+                logger.error(f"Batch item {index} ({filenames[index]}) failed: {results}")
+                line = {'type': 'result', 'success': False, 'index': index, 'filename': filenames[index],
+                        'error': str(results) or type(results).__name__}
+                if isinstance(results, AlignmentError):
+                    line.update(status='unalignable', alignment=results.quality)
+            else:
+                analysis_id = str(uuid.uuid4())
+                with Trace():
+                    merge_trace(results.pop('stages', None))
+                    encoded, _ = encode_artifacts(results, persist)
+                persist_in_background(analysis_id, encoded, build_summary(analysis_id, results, options, persist))
+                metrics = results_metrics(results)
+                line = {
+                    'type': 'result',
+                    'success': True,
+                    'index': index,
+                    'filename': filenames[index],
+                    'analysis_id': analysis_id,
+                    'results': metrics,
+                    'artifacts': {name: url_for('get_job_artifact', analysis_id=analysis_id, name=name)
+                                  for name in persist}
+                }
+                ranking.append({
+                    'index': index,
+                    'filename': filenames[index],
+                    'analysis_id': analysis_id,
+                    'difference_percentage': metrics['difference_percentage'],
+                    'similarity': metrics['similarity']
+                })
+            yield app.json.dumps(line) + '\n'
+        
+        # Most different first; ties broken by the lower similarity
+        ranking.sort(key=lambda item: (-item['difference_percentage'], item['similarity']))
+        logger.info(f"Batch complete: {len(ranking)}/{len(buffers)} succeeded")
+        yield app.json.dumps({
+            'type': 'summary',
+            'success': len(ranking) == len(buffers),
+            'reference_id': options['reference_id'],
+            'total': len(buffers),
+            'succeeded': len(ranking),
+            'failed': len(buffers) - len(ranking),
+            'parameters': options,
+            'ranking': ranking
+        }) + '\n'
+    
+    response = app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+    if uploaded_reference:
+        response.call_on_close(lambda: release_batch_reference(options['reference_id']))
+    return response
+
+@app.route('/jobs', methods=['POST'])
+@require_api_key
+def submit_job():
+    error_response = validate_image_uploads(request.files, comparison_uploads())
+    if error_response is not None:
+        return error_response
+    
+    try:
+        image1_data = b'' if request.form.get('reference_id') else bytes(read_upload(request.files['image1']))
+        image2_data = bytes(read_upload(request.files['image2']))
+        options = parse_comparison_options(request.form)
+        persist = request.form.get('persist')
+        persist = DEFAULT_PERSIST_ARTIFACTS if persist is None else parse_persist_selection(persist)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': f'Invalid parameter: {e}',
+            'details': 'Check sensitivity, min_area, alignment_method, ssim_threshold and persist'
+        }), 400
+    if options['reference_id'] and not reference_store.exists(options['reference_id']):
+        return unknown_reference_response(options['reference_id'])
+    
+    # Retries of the same upload map to the same analysis_id
+    key = request.headers.get('Idempotency-Key') or job_key(image1_data, image2_data, options, persist)
+    analysis_id = job_id_for_key(key)
+    
+    try:
+        status, created = job_manager.submit(analysis_id, run_job, image1_data, image2_data, options, persist)
+    except JobQueueFullError as e:
+        logger.warning(f"Rejecting job: {e}")
+        return jsonify({
+            'success': False,
+            'error': 'Too many pending jobs, retry later',
+            'details': str(e)
+        }), 503, {'Retry-After': str(RETRY_AFTER_SECONDS)}
+    
+    logger.info(f"Job {analysis_id} {'created' if created else 'already known'}")
+    return jsonify({
+        'success': True,
+        'analysis_id': analysis_id,
+        'status': status['status'] if status else 'done',
+        'status_url': url_for('get_job', analysis_id=analysis_id)
+    }), 202 if created else 200
+
+@app.route('/jobs/<uuid:analysis_id>')
+@require_api_key
+def get_job(analysis_id):
+    analysis_id = str(analysis_id)
+    status = job_manager.get(analysis_id)
+    if status is not None:
+        return jsonify({'success': True, **status})
+    
+    summary = load_analysis_summary(analysis_id)
+    if summary is None:
+        return jsonify({'success': False, 'error': 'Unknown analysis_id'}), 404
+    
+    artifacts = {
+        name: url_for('get_job_artifact', analysis_id=analysis_id, name=name)
+        for name in summary.get('saved_files', {})
+    }
+    return jsonify({
+        'success': True,
+        'analysis_id': analysis_id,
+        'status': 'done',
+        'finished_at': summary['timestamp'],
+        'results': {
+            'num_differences': summary['num_differences'],
+            'similarity': summary['similarity'],
+            'difference_percentage': summary['difference_percentage'],
+            'bounding_boxes': summary.get('bounding_boxes'),
+            'regions': summary.get('regions'),
+            'working_size': summary.get('working_size'),
+            'original_size': summary.get('original_size'),
+            'alignment_method': summary['alignment_method'],
+            'alignment': summary.get('alignment')
+        },
+        'parameters': summary.get('parameters'),
+        'artifacts': artifacts
+    })
+
+@app.route('/jobs/<uuid:analysis_id>/artifacts/<name>')
+@require_api_key
+def get_job_artifact(analysis_id, name):
+    analysis_id = str(analysis_id)
+    summary = load_analysis_summary(analysis_id)
+    saved_files = summary.get('saved_files', {}) if summary else {}
+    if name not in saved_files:
+        return jsonify({'success': False, 'error': 'Unknown artifact'}), 404
+    # Summaries written on Windows store backslash-separated paths
+    filename = saved_files[name].replace('\\', '/').rsplit('/', 1)[-1]
+    results_dir = os.path.join(app.config['RESULTS_FOLDER'], analysis_id)
+    try:
+        max_dimension = parse_max_dimension(request.args.get('max_dimension'))
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': f'Invalid parameter: {e}',
+            'details': 'max_dimension is a positive number of pixels'
+        }), 400
+    if max_dimension:
+        image = cv2.imread(os.path.join(results_dir, filename))
+        if image is None:
+            return jsonify({'success': False, 'error': 'Unknown artifact'}), 404
+        return app.response_class(encode_jpeg(image, 80, max_dimension).tobytes(), mimetype='image/jpeg')
+    return send_from_directory(os.path.abspath(results_dir), filename, max_age=3600)
+
+@app.route('/references', methods=['POST'])
+@require_api_key
+def create_reference():
+    error_response = validate_image_uploads(request.files, ('image',))
+    if error_response is not None:
+        return error_response
+    try:
+        with batch_references_lock:
+            reference_id, entry, created = register_reference(read_upload(request.files['image']))
+            # Registered explicitly now: running batches no longer delete it
+            created = batch_references.pop(reference_id, None) is not None or created
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e),
+            'details': 'Upload a supported image format'
+        }), 400
+    return jsonify({
+        'success': True,
+        'reference_id': reference_id,
+        **entry
+    }), 201 if created else 200
+
+@app.route('/references')
+@require_api_key
+def list_references():
+    return jsonify({
+        'success': True,
+        'references': [{'reference_id': reference_id, **entry}
+                       for reference_id, entry in reference_store.list().items()]
+    })
+
+def parse_timestamp(value):
+    """Epoch seconds of an ISO 8601 query parameter, or None"""
+    return datetime.fromisoformat(value).timestamp() if value else None
+
+@app.route('/analyses')
+@require_api_key
+def list_analyses():
+    """Persisted analyses from the index, newest first; filters: since, until, alignment_method"""
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), ANALYSES_MAX_LIMIT)
+        offset = max(int(request.args.get('offset', 0)), 0)
+        since = parse_timestamp(request.args.get('since'))
+        until = parse_timestamp(request.args.get('until'))
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': f'Invalid parameter: {e}',
+            'details': 'limit and offset are integers, since and until ISO 8601 timestamps'
+        }), 400
+    analyses, total, total_bytes = analysis_index.query(limit, offset, since, until,
+                                                        request.args.get('alignment_method'))
+    for entry in analyses:
+        entry['status_url'] = url_for('get_job', analysis_id=entry['analysis_id'])
+    return jsonify({
+        'success': True,
+        'total': total,
+        'total_bytes': total_bytes,
+        'limit': limit,
+        'offset': offset,
+        'analyses': analyses
+    })
+
+@app.route('/references/<reference_id>', methods=['DELETE'])
+@require_api_key
+def delete_reference(reference_id):
+    if not reference_store.delete(reference_id):
+        return unknown_reference_response(reference_id)
+    logger.info(f"Reference {reference_id} deleted")
+    return jsonify({'success': True, 'reference_id': reference_id})
+
 @app.errorhandler(413)
 def too_large(e):
     return jsonify({
@@ -463,11 +2110,16 @@ if __name__ == '__main__':
     print(f"Results folder: {RESULTS_FOLDER}")
     print(f"Max file size: {MAX_CONTENT_LENGTH / (1024*1024):.1f}MB")
     print(f"Max resolution: {MAX_RESOLUTION}x{MAX_RESOLUTION} pixels")
+    print(f"Worker processes: {WORKER_PROCESSES or 'disabled (inline)'}")
     print("=" * 60)
     print("API Endpoints:")
     print("  GET  /           - API information")
     print("  GET  /health     - Health check")
+    print("  GET  /metrics    - Stage timings (Prometheus)")
+    print("  GET  /analyses   - Persisted analyses")
     print("  POST /compare_images - Compare two images")
+    print("  POST /jobs           - Submit a background comparison")
+    print("  GET  /jobs/<id>      - Job status and metrics")
     print("=" * 60)
     print("Connection URLs:")
     print("  Local:           http://localhost:5000")
@@ -475,4 +2127,10 @@ if __name__ == '__main__':
     print("  iOS Simulator:   http://localhost:5000")
     print("  Network:         http://YOUR_IP:5000")
     print("=" * 60)
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    print("Development server; use wsgi.py (waitress) or gunicorn 'wsgi:app' in production")
+    print("=" * 60)
+    debug = os.environ.get('FLASK_DEBUG', '1') == '1'
+    # With the reloader, only the child process that serves requests maintains results/
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_maintenance()
+    app.run(debug=debug, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,52 @@
+"""Time each alignment method on a shifted/rotated synthetic pair.
+
+Residual is the mean absolute grey-level difference over the central half of
+the aligned pair (lower is better). Run from the backend folder:
+    python -m benchmarks.bench_alignment --width 1500 --height 1125 --angle 1.5
+"""
+import argparse
+import logging
+import time
+
+import cv2
+import numpy as np
+
+from app import ImageFrame, PreciseImageDifferenceDetector
+from benchmarks.synthetic import make_pair
+
+METHODS = ['phase', 'phase_pyramid', 'ecc', 'ecc_pyramid', 'features', 'features_pyramid', 'auto']
+
+
+def residual(frame1, frame2):
+    h, w = frame2.shape[:2]
+    crop = (slice(h // 4, 3 * h // 4), slice(w // 4, 3 * w // 4))
+    return float(np.mean(cv2.absdiff(frame1.gray[crop], frame2.gray[crop])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--width', type=int, default=1500)
+    parser.add_argument('--height', type=int, default=1125)
+    parser.add_argument('--shift', type=float, nargs=2, default=[12.0, -7.0])
+    parser.add_argument('--angle', type=float, default=0.0)
+    parser.add_argument('--methods', nargs='+', default=METHODS)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    img1, img2 = make_pair(args.width, args.height, shift=tuple(args.shift), angle=args.angle)
+    print(f"unaligned residual: {residual(ImageFrame(img1), ImageFrame(img2)):.2f}")
+    print(f"{'method':>17} {'best ms':>9} {'residual':>9}")
+    for method in args.methods:
+        detector = PreciseImageDifferenceDetector()
+        detector.set_alignment_method(method)
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            frame1, frame2 = detector.align_images(ImageFrame(img1), ImageFrame(img2))
+            timings.append(time.perf_counter() - start)
+        print(f"{method:>17} {min(timings) * 1000:>9.1f} {residual(frame1, frame2):>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
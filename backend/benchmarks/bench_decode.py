@@ -0,0 +1,69 @@
+"""Compare the legacy save-to-disk decode path with in-memory decoding.
+
+Run from the backend folder:
+    python -m benchmarks.bench_decode --width 3000 --height 2000 --requests 16 --concurrency 1 4
+"""
+import argparse
+import logging
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import PreciseImageDifferenceDetector
+from benchmarks.synthetic import make_pair, encode_jpeg
+
+
+def legacy_request(data1, data2):
+    """What /compare_images used to do: write both uploads, read them back, rmtree"""
+    start = time.perf_counter()
+    temp_dir = tempfile.mkdtemp(dir='uploads')
+    try:
+        path1 = os.path.join(temp_dir, 'image1.jpg')
+        path2 = os.path.join(temp_dir, 'image2.jpg')
+        with open(path1, 'wb') as f:
+            f.write(data1)
+        with open(path2, 'wb') as f:
+            f.write(data2)
+        PreciseImageDifferenceDetector().process_images_from_files(path1, path2)
+    finally:
+        shutil.rmtree(temp_dir)
+    return time.perf_counter() - start
+
+
+def buffer_request(data1, data2):
+    start = time.perf_counter()
+    PreciseImageDifferenceDetector().process_images_from_buffers(memoryview(data1), memoryview(data2))
+    return time.perf_counter() - start
+
+
+def run(fn, data1, data2, requests, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(lambda _: fn(data1, data2), range(requests)))
+    return statistics.mean(latencies) * 1000, max(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--width', type=int, default=3000)
+    parser.add_argument('--height', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=16)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    img1, img2 = make_pair(args.width, args.height, shift=(6.0, -4.0))
+    data1, data2 = encode_jpeg(img1), encode_jpeg(img2)
+    os.makedirs('uploads', exist_ok=True)
+
+    print(f"{'concurrency':>11} {'disk mean ms':>13} {'memory mean ms':>15} {'saved ms':>9}")
+    for concurrency in args.concurrency:
+        legacy_mean, _ = run(legacy_request, data1, data2, args.requests, concurrency)
+        buffer_mean, _ = run(buffer_request, data1, data2, args.requests, concurrency)
+        print(f"{concurrency:>11} {legacy_mean:>13.1f} {buffer_mean:>15.1f} {legacy_mean - buffer_mean:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Peak allocation of one comparison, with and without the shared ImageFrame views.
+
+The "before" pipeline replays the stage sequence the detector used before
+ImageFrame existed: every stage converts to grayscale/float on its own.
+Each variant runs in a fresh process so peak RSS is comparable. SSIM is the
+largest single allocation; --no-ssim replaces it with a no-op in both variants
+to isolate the rest of the pipeline. Run from the backend folder:
+    python -m benchmarks.bench_memory --width 1500 --height 1125 [--no-ssim]
+"""
+import argparse
+import logging
+import multiprocessing
+import resource
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from skimage.metrics import structural_similarity as ssim
+
+import app
+from app import PreciseImageDifferenceDetector
+from benchmarks.synthetic import make_pair
+
+
+def before(img1, img2):
+    detector = PreciseImageDifferenceDetector()
+    gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
+    gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+    shift, _ = cv2.phaseCorrelate(np.float32(gray1), np.float32(gray2))
+    M = np.float32([[1, 0, shift[0]], [0, 1, shift[1]]])
+    aligned1 = cv2.warpAffine(img1, M, (img2.shape[1], img2.shape[0]))
+    superposition = np.clip(cv2.addWeighted(aligned1.astype(np.float32), 0.5,
+                                            img2.astype(np.float32), 0.5, 0), 0, 255).astype(np.uint8)
+    blur1 = cv2.GaussianBlur(cv2.cvtColor(aligned1, cv2.COLOR_BGR2GRAY), (3, 3), 0)
+    blur2 = cv2.GaussianBlur(cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY), (3, 3), 0)
+    diff = cv2.absdiff(blur1, blur2)
+    _, thresh = cv2.threshold(diff, 25, 255, cv2.THRESH_BINARY)
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    rects = np.int32([cv2.boundingRect(c) for c in contours]).reshape(-1, 4)
+    marked1, marked2 = detector.draw_differences_on_images(aligned1, img2, rects)
+    superposition_marked = np.clip(cv2.addWeighted(marked1.astype(np.float32), 0.5,
+                                                   marked2.astype(np.float32), 0.5, 0), 0, 255).astype(np.uint8)
+    ssim(cv2.cvtColor(aligned1, cv2.COLOR_BGR2GRAY), cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY))
+    return superposition, superposition_marked
+
+
+def after(img1, img2):
+    return PreciseImageDifferenceDetector().process_images_from_arrays(img1, img2)
+
+
+def measure(name, width, height, no_ssim, queue):
+    logging.disable(logging.INFO)
+    if no_ssim:
+        global ssim
+        ssim = app.structural_similarity = lambda *args, **kwargs: 0.0
+    img1, img2 = make_pair(width, height, shift=(6.0, -4.0))
+    fn = before if name == 'before' else after
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn(img1, img2)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put((name, peak / (1024 * 1024), max_rss, elapsed * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--width', type=int, default=1500)
+    parser.add_argument('--height', type=int, default=1125)
+    parser.add_argument('--no-ssim', action='store_true')
+    args = parser.parse_args()
+
+    queue = multiprocessing.Queue()
+    print(f"{'pipeline':>9} {'traced peak MB':>15} {'peak RSS MB':>12} {'ms':>8}")
+    for name in ('before', 'after'):
+        process = multiprocessing.Process(target=measure, args=(name, args.width, args.height, args.no_ssim, queue))
+        process.start()
+        name, peak, max_rss, elapsed = queue.get()
+        process.join()
+        print(f"{name:>9} {peak:>15.1f} {max_rss:>12.1f} {elapsed:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
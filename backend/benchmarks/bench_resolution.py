@@ -0,0 +1,54 @@
+"""End-to-end comparison time against input megapixels.
+
+Compares a full-resolution decode with the reduced (DCT-scaled) decode used by
+process_images_from_buffers. Run from the backend folder:
+    python -m benchmarks.bench_resolution --megapixels 1 4 12 24
+"""
+import argparse
+import logging
+import math
+import time
+
+from app import PreciseImageDifferenceDetector, decode_image
+from benchmarks.synthetic import make_pair, encode_jpeg
+
+
+def full_decode_request(data1, data2):
+    detector = PreciseImageDifferenceDetector()
+    img1, img2 = decode_image(data1), decode_image(data2)
+    return detector.process_images_from_arrays(img1, img2)
+
+
+def reduced_decode_request(data1, data2):
+    return PreciseImageDifferenceDetector().process_images_from_buffers(data1, data2)
+
+
+def best_of(fn, data1, data2, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(data1, data2)
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[1, 4, 12, 24])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    print(f"{'MP':>5} {'size':>11} {'full decode ms':>15} {'reduced decode ms':>18}")
+    for mp in args.megapixels:
+        width = int(math.sqrt(mp * 1e6 * 4 / 3))
+        height = int(width * 3 / 4)
+        img1, img2 = make_pair(width, height, shift=(8.0, -5.0))
+        data1, data2 = encode_jpeg(img1), encode_jpeg(img2)
+        full = best_of(full_decode_request, data1, data2, args.repeat)
+        reduced = best_of(reduced_decode_request, data1, data2, args.repeat)
+        print(f"{mp:>5.0f} {f'{width}x{height}':>11} {full:>15.1f} {reduced:>18.1f}")
+
+
+if __name__ == '__main__':
+    main()
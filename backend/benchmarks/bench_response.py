@@ -0,0 +1,64 @@
+"""Response size and server CPU per /compare_images request for each response mode.
+
+CPU is process time spent serving the request in-process through Flask's
+test client. The result cache is disabled, so every request decodes, aligns
+and compares the pair again and the differences between rows are the cost
+of building the response. Results are written to a temporary folder. Run from the backend folder:
+    python -m benchmarks.bench_response --width 2000 --height 1500 --requests 5
+"""
+import argparse
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import make_pair, encode_jpeg
+
+CASES = [
+    ('full', {}),
+    ('full, difference only', {'images': 'difference_image'}),
+    ('full, max 800px', {'max_dimension': '800'}),
+    ('metrics', {'response_mode': 'metrics'}),
+    ('urls', {'response_mode': 'urls'}),
+    ('multipart', {'response_mode': 'multipart'}),
+    ('multipart, max 800px', {'response_mode': 'multipart', 'max_dimension': '800'}),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--width', type=int, default=2000)
+    parser.add_argument('--height', type=int, default=1500)
+    parser.add_argument('--requests', type=int, default=5)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='bench_response_'))
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as app_module
+    app_module.result_cache.max_bytes = 0
+    logging.disable(logging.INFO)
+
+    img1, img2 = make_pair(args.width, args.height, shift=(6.0, -4.0))
+    data1, data2 = encode_jpeg(img1), encode_jpeg(img2)
+    client = app_module.app.test_client()
+
+    print(f"{'mode':>22} {'bytes':>10} {'cpu ms':>8}")
+    for label, fields in CASES:
+        sizes, cpu = [], []
+        for _ in range(args.requests):
+            start = time.process_time()
+            response = client.post('/compare_images', headers={'X-API-Key': app_module.API_KEY}, data={
+                'image1': (io.BytesIO(data1), 'image1.jpg'),
+                'image2': (io.BytesIO(data2), 'image2.jpg'),
+                **fields
+            }, content_type='multipart/form-data')
+            cpu.append(time.process_time() - start)
+            assert response.status_code == 200, response.data[:200]
+            sizes.append(len(response.data))
+        print(f"{label:>22} {min(sizes):>10} {sorted(cpu)[len(cpu) // 2] * 1000:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
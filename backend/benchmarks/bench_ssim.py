@@ -0,0 +1,53 @@
+"""fast_ssim against skimage.metrics.structural_similarity at several sizes.
+
+Run from the backend folder:
+    python -m benchmarks.bench_ssim --megapixels 1 4 12
+"""
+import argparse
+import math
+import time
+
+import cv2
+from skimage.metrics import structural_similarity as skimage_ssim
+
+from benchmarks.synthetic import make_pair
+from fast_ssim import SSIM_TOLERANCE, structural_similarity
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = fn()
+        timings.append(time.perf_counter() - start)
+    return value, min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[1, 4, 12])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tile-rows', type=int, default=256)
+    args = parser.parse_args()
+
+    print(f"{'MP':>4} {'skimage ms':>11} {'fast ms':>8} {'speedup':>8} {'|err|':>9} "
+          f"{'tiled ms':>9} {'1/2 ms':>7} {'1/2 err':>8}")
+    for mp in args.megapixels:
+        width = int(math.sqrt(mp * 1e6 * 4 / 3))
+        height = int(width * 3 / 4)
+        img1, img2 = make_pair(width, height, shift=(2.0, 1.0))
+        gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
+        gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+
+        reference, skimage_ms = best_of(lambda: skimage_ssim(gray1, gray2), args.repeat)
+        fast, fast_ms = best_of(lambda: structural_similarity(gray1, gray2), args.repeat)
+        tiled, tiled_ms = best_of(lambda: structural_similarity(gray1, gray2, tile_rows=args.tile_rows), args.repeat)
+        half, half_ms = best_of(lambda: structural_similarity(gray1, gray2, downsample=2), args.repeat)
+        error = abs(fast - reference)
+        assert error <= SSIM_TOLERANCE and abs(tiled - fast) <= 1e-9, (reference, fast, tiled)
+        print(f"{mp:>4.0f} {skimage_ms:>11.1f} {fast_ms:>8.1f} {skimage_ms / fast_ms:>7.1f}x {error:>9.1e} "
+              f"{tiled_ms:>9.1f} {half_ms:>7.1f} {abs(half - reference):>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+"""Latency, memory and accuracy of /compare_images on synthetic pairs with known ground truth.
+
+Every scenario (shift, small and large rotation, noise + strong JPEG) is generated at each
+resolution with injected defects, then sent through Flask's test client
+once per alignment method, --repeat times. The result cache is disabled so
+every request runs the whole pipeline, and artifacts are not persisted
+unless --persist asks for it.
+
+Per scenario, resolution and method the JSON report gives latency
+(min/median/p95), sequential throughput, the growth of peak RSS, the
+median per-stage breakdown (timings=true), recall of the injected
+defects (a defect counts when one returned box covers half of it), boxes
+that touch no defect, and the alignment error: the median residual
+shift, in original pixels, between the returned aligned images measured
+by phase correlation in a grid of windows. A pair the method cannot align
+(HTTP 422) is reported with status "unalignable" and its quality signal.
+The report ends with per-method averages over all cases, with the methods
+auto mode escalated through, to weigh a method against always using ECC:
+    python -m benchmarks.bench_suite --methods auto ecc --output auto.json
+
+--baseline compares against an earlier report and exits with status 1 on
+slower medians (beyond --tolerance), lower recall or larger alignment
+error, or on pairs that became unalignable. Run from the backend folder:
+    python -m benchmarks.bench_suite --output report.json
+    python -m benchmarks.bench_suite --resolutions 800x600 --repeat 2 --baseline report.json
+"""
+import argparse
+import base64
+import collections
+import io
+import json
+import logging
+import math
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+import app as app_module
+from benchmarks.bench_alignment import METHODS
+from benchmarks.bench_tiles import read_status, reset_peak_rss
+from benchmarks.synthetic import encode_jpeg, make_case
+
+# Shifts are fractions of the width so every resolution sees the same misalignment
+SCENARIOS = {
+    'shift': {'shift': (0.0075, -0.0045), 'angle': 0.0, 'noise': 2.0, 'jpeg_quality': 92},
+    'rotation': {'shift': (0.004, 0.0025), 'angle': 1.0, 'noise': 2.0, 'jpeg_quality': 92},
+    'large_rotation': {'shift': (0.004, 0.0025), 'angle': 20.0, 'noise': 2.0, 'jpeg_quality': 92},
+    'noisy': {'shift': (0.0075, -0.0045), 'angle': 0.0, 'noise': 8.0, 'jpeg_quality': 70},
+}
+DEFECTS = 5
+LATENCY_TOLERANCE = 0.2
+RECALL_TOLERANCE = 0.01
+ALIGNMENT_TOLERANCE_PX = 1.0
+
+
+def parse_resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def decode_base64(data):
+    return cv2.imdecode(np.frombuffer(base64.b64decode(data), np.uint8), cv2.IMREAD_GRAYSCALE)
+
+
+def alignment_error(aligned1, aligned2):
+    """Median residual shift (working pixels) between two aligned grayscale images.
+
+    Measured in a 3x3 grid of windows, so a rotation shows up as shifts
+    away from the centre; the median ignores windows biased by a defect.
+    """
+    h, w = aligned2.shape
+    # Power-of-two windows: phaseCorrelate is biased by half a pixel when a DFT size is odd
+    ch, cw = 1 << int(math.log2(h // 5)), 1 << int(math.log2(w // 5))
+    window = cv2.createHanningWindow((cw, ch), cv2.CV_32F)
+    errors = []
+    for fy in (0.2, 0.5, 0.8):
+        for fx in (0.2, 0.5, 0.8):
+            y, x = int(fy * h) - ch // 2, int(fx * w) - cw // 2
+            crop1 = np.float32(aligned1[y:y + ch, x:x + cw])
+            crop2 = np.float32(aligned2[y:y + ch, x:x + cw])
+            (dx, dy), _ = cv2.phaseCorrelate(crop1, crop2, window)
+            errors.append(math.hypot(dx, dy))
+    return statistics.median(errors)
+
+
+def score_detections(boxes, defects):
+    """(recall, boxes touching no defect) of original-coordinate boxes against defect boxes"""
+    def overlap(box, defect):
+        x, y, w, h = defect
+        ix = max(0, min(box['x'] + box['width'], x + w) - max(box['x'], x))
+        iy = max(0, min(box['y'] + box['height'], y + h) - max(box['y'], y))
+        return ix * iy
+    originals = [box['original'] for box in boxes]
+    found = sum(1 for defect in defects
+                if any(overlap(box, defect) >= defect[2] * defect[3] / 2 for box in originals))
+    stray = sum(1 for box in originals if not any(overlap(box, defect) for defect in defects))
+    return found / len(defects), stray
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(q * (len(ordered) - 1)))]
+
+
+def run_case(client, api_key, data1, data2, defects, method, args):
+    latencies, stages, peak_rss = [], {}, None
+    baseline = reset_peak_rss()
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        response = client.post('/compare_images', headers={'X-API-Key': api_key}, data={
+            'image1': (io.BytesIO(data1), 'image1.jpg'),
+            'image2': (io.BytesIO(data2), 'image2.jpg'),
+            'alignment_method': method,
+            'persist': args.persist,
+            'timings': 'true'
+        }, content_type='multipart/form-data')
+        latencies.append(time.perf_counter() - start)
+        body = response.get_json()
+        if response.status_code == 422:
+            return {
+                'status': 'unalignable',
+                'latency_ms': {'median': round(statistics.median(latencies) * 1000, 1)},
+                'alignment': body['alignment'],
+                'error': body['error']
+            }
+        if response.status_code != 200:
+            raise RuntimeError(f"{method}: HTTP {response.status_code} {body}")
+        for name, timing in body['timings']['stages'].items():
+            stages.setdefault(name, []).append(timing['wall_ms'])
+    if baseline is not None:
+        peak_rss = round(read_status('VmHWM') - baseline, 1)
+
+    results = body['results']
+    scale = results['original_size'][0] / results['working_size'][0]
+    error = alignment_error(decode_base64(results['original_image1']), decode_base64(results['original_image2']))
+    recall, stray = score_detections(results['bounding_boxes'], defects)
+    return {
+        'status': 'ok',
+        'latency_ms': {
+            'min': round(min(latencies) * 1000, 1),
+            'median': round(statistics.median(latencies) * 1000, 1),
+            'p95': round(percentile(latencies, 0.95) * 1000, 1)
+        },
+        'throughput_rps': round(len(latencies) / sum(latencies), 3),
+        'peak_rss_mb': peak_rss,
+        'stages_ms': {name: round(statistics.median(values), 2) for name, values in stages.items()},
+        'recall': recall,
+        'stray_boxes': stray,
+        'num_differences': results['num_differences'],
+        'alignment_error_px': round(error * scale, 2),
+        'working_size': results['working_size'],
+        'alignment': results['alignment']
+    }
+
+
+def summarize(results):
+    """Per-method averages: latency, recall and alignment error over the aligned cases"""
+    summary = {}
+    for method in dict.fromkeys(result['method'] for result in results):
+        cases = [result for result in results if result['method'] == method]
+        aligned = [result for result in cases if result['status'] == 'ok']
+        summary[method] = {
+            'cases': len(cases),
+            'unalignable': len(cases) - len(aligned),
+            'mean_latency_ms': round(statistics.mean(result['latency_ms']['median'] for result in cases), 1),
+            'mean_recall': round(statistics.mean(result['recall'] for result in aligned), 3) if aligned else None,
+            'mean_alignment_error_px': (round(statistics.mean(result['alignment_error_px'] for result in aligned), 2)
+                                        if aligned else None)
+        }
+        paths = [' -> '.join(step['method'] for step in result['alignment']['path'])
+                 for result in aligned if result['alignment'] and 'path' in result['alignment']]
+        if paths:
+            summary[method]['paths'] = dict(collections.Counter(paths))
+    return summary
+
+
+def find_regressions(report, baseline, tolerance):
+    previous = {(r['scenario'], r['resolution'], r['method']): r for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        key = (result['scenario'], result['resolution'], result['method'])
+        before = previous.get(key)
+        if before is None:
+            continue
+        label = '/'.join(key)
+        if result['status'] != before.get('status', 'ok'):
+            if result['status'] == 'unalignable':
+                regressions.append(f"{label}: now unalignable")
+            continue
+        if result['status'] == 'unalignable':
+            continue
+        if result['latency_ms']['median'] > before['latency_ms']['median'] * (1 + tolerance):
+            regressions.append(f"{label}: median {before['latency_ms']['median']} -> "
+                               f"{result['latency_ms']['median']} ms")
+        if result['recall'] < before['recall'] - RECALL_TOLERANCE:
+            regressions.append(f"{label}: recall {before['recall']} -> {result['recall']}")
+        if result['alignment_error_px'] > before['alignment_error_px'] + ALIGNMENT_TOLERANCE_PX:
+            regressions.append(f"{label}: alignment error {before['alignment_error_px']} -> "
+                               f"{result['alignment_error_px']} px")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--resolutions', type=parse_resolution, nargs='+',
+                        default=[(800, 600), (1600, 1200), (4000, 3000)])
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--methods', nargs='+', default=METHODS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--persist', default='none', help="persist field sent with each request")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--baseline', help="earlier report to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=LATENCY_TOLERANCE,
+                        help="allowed relative growth of median latency")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    # Persisted artifacts go to a scratch folder; no cache, so every request runs the full pipeline
+    os.chdir(tempfile.mkdtemp(prefix='bench_suite_'))
+    app_module.result_cache.max_bytes = 0
+    logging.disable(logging.INFO)
+    client = app_module.app.test_client()
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+            'max_resolution': app_module.MAX_RESOLUTION,
+            'worker_processes': app_module.WORKER_PROCESSES
+        },
+        'config': {
+            'scenarios': {name: SCENARIOS[name] for name in args.scenarios},
+            'defects': DEFECTS,
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'persist': args.persist
+        },
+        'results': []
+    }
+    for scenario in args.scenarios:
+        params = SCENARIOS[scenario]
+        for width, height in args.resolutions:
+            shift = (params['shift'][0] * width, params['shift'][1] * width)
+            reference, inspection, defects = make_case(width, height, shift, params['angle'], DEFECTS,
+                                                       params['noise'], args.seed)
+            data1 = encode_jpeg(reference, params['jpeg_quality'])
+            data2 = encode_jpeg(inspection, params['jpeg_quality'])
+            for method in args.methods:
+                result = run_case(client, app_module.API_KEY, data1, data2, defects, method, args)
+                report['results'].append({'scenario': scenario, 'resolution': f'{width}x{height}',
+                                          'method': method, **result})
+                if result['status'] == 'unalignable':
+                    outcome = result['error']
+                else:
+                    outcome = (f"recall {result['recall']:.2f}, "
+                               f"alignment error {result['alignment_error_px']:.2f} px")
+                print(f"{scenario:>9} {width}x{height} {method:>17}: {result['latency_ms']['median']:>8.1f} ms, "
+                      f"{outcome}", file=sys.stderr)
+
+    report['summary'] = summarize(report['results'])
+    for method, averages in report['summary'].items():
+        print(f"{method:>17}: mean {averages['mean_latency_ms']:>8.1f} ms, recall {averages['mean_recall']}, "
+              f"alignment error {averages['mean_alignment_error_px']} px, "
+              f"unalignable {averages['unalignable']}/{averages['cases']}", file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = find_regressions(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Peak memory of the detection stage, full frame against tiled, by image size.
+
+Runs difference_map + threshold_differences on an aligned pair whose
+grayscale views already exist (the aligners and SSIM compute them anyway),
+so the numbers are what detection itself adds. Each case runs in a fresh
+process. "RSS MB" is the growth of the resident-set high-water mark during
+detection (reset through /proc/self/clear_refs on Linux); "traced MB" is
+the numpy/OpenCV-output peak from tracemalloc. Run from the backend folder:
+    python -m benchmarks.bench_tiles --megapixels 4 16 36 --tile-size 512
+"""
+import argparse
+import logging
+import math
+import multiprocessing
+import resource
+import time
+import tracemalloc
+
+import numpy as np
+
+from app import ImageFrame, PreciseImageDifferenceDetector
+from benchmarks.synthetic import make_pair
+
+
+def read_status(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+    raise KeyError(field)
+
+
+def reset_peak_rss():
+    """Reset VmHWM to the current RSS; returns the baseline in MB, or None if unsupported"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return read_status('VmRSS')
+    except OSError:
+        return None
+
+
+def measure(width, height, tile_size, queue):
+    logging.disable(logging.INFO)
+    img1, img2 = make_pair(width, height, shift=(3.0, -2.0))
+    frame1, frame2 = ImageFrame(img1), ImageFrame(img2)
+    frame1.gray, frame2.gray
+    detector = PreciseImageDifferenceDetector()
+    detector.tile_size = tile_size
+
+    baseline = reset_peak_rss()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    tracemalloc.start()
+    start = time.perf_counter()
+    diff = detector.difference_map(frame1, frame2)
+    regions, thresh = detector.threshold_differences(diff)
+    elapsed = time.perf_counter() - start
+    _, traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if baseline is not None:
+        rss = read_status('VmHWM') - baseline
+    else:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - before
+    queue.put((traced / (1024 * 1024), rss, elapsed * 1000, len(regions['rects']), int(np.count_nonzero(thresh))))
+
+
+def run(width, height, tile_size):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(width, height, tile_size, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[4, 16, 36])
+    parser.add_argument('--tile-size', type=int, default=512)
+    args = parser.parse_args()
+
+    print(f"{'MP':>4} {'mode':>10} {'traced MB':>10} {'RSS MB':>8} {'ms':>8} {'regions':>8}")
+    for mp in args.megapixels:
+        width = int(math.sqrt(mp * 1e6 * 4 / 3))
+        height = int(width * 3 / 4)
+        outputs = set()
+        for label, tile_size in (('full', None), (f'tiled {args.tile_size}', args.tile_size)):
+            traced, rss, elapsed, regions, mask_pixels = run(width, height, tile_size)
+            outputs.add((regions, mask_pixels))
+            print(f"{mp:>4.0f} {label:>10} {traced:>10.1f} {rss:>8.1f} {elapsed:>8.1f} {regions:>8}")
+        assert len(outputs) == 1, f"tiled output differs from full frame at {mp} MP"
+
+
+if __name__ == '__main__':
+    main()
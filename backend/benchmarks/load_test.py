@@ -0,0 +1,83 @@
+"""Load-test /compare_images through the worker pool at several worker counts.
+
+Requests go through Flask's test client from concurrent threads, so the
+whole route (upload parsing, pool admission, encoding) is exercised without
+a network. Every request posts the same pair, so the result cache is
+disabled to make each one run the full comparison. Results are written to a
+temporary folder. Run from the backend folder:
+    python -m benchmarks.load_test --workers 1 2 4 --requests 24 --concurrency 8
+"""
+import argparse
+import io
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.synthetic import make_pair, encode_jpeg
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--requests', type=int, default=24)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--queue-depth', type=int, default=8)
+    parser.add_argument('--width', type=int, default=2000)
+    parser.add_argument('--height', type=int, default=1500)
+    parser.add_argument('--alignment-method', default='phase')
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='load_test_'))
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as app_module
+    from worker_pool import ComparisonPool
+    app_module.result_cache.max_bytes = 0
+    logging.disable(logging.WARNING)
+
+    img1, img2 = make_pair(args.width, args.height, shift=(6.0, -4.0))
+    data1, data2 = encode_jpeg(img1), encode_jpeg(img2)
+
+    def one_request(_):
+        client = app_module.app.test_client()
+        start = time.perf_counter()
+        response = client.post('/compare_images', headers={'X-API-Key': app_module.API_KEY}, data={
+            'image1': (io.BytesIO(data1), 'image1.jpg'),
+            'image2': (io.BytesIO(data2), 'image2.jpg'),
+            'alignment_method': args.alignment_method
+        }, content_type='multipart/form-data')
+        return response.status_code, time.perf_counter() - start
+
+    print(f"{'workers':>7} {'req/s':>7} {'p50 ms':>8} {'p99 ms':>8} {'ok':>4} {'503':>4} {'other':>5}")
+    for workers in args.workers:
+        pool = ComparisonPool(workers, args.queue_depth, app_module.WORKER_JOB_TIMEOUT)
+        app_module.WORKER_PROCESSES = workers
+        app_module.comparison_pool = pool
+        one_request(None)  # Wait for the workers to warm up
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as threads:
+            outcomes = list(threads.map(one_request, range(args.requests)))
+        elapsed = time.perf_counter() - start
+        pool.shutdown()
+
+        latencies = [t * 1000 for status, t in outcomes if status == 200]
+        rejected = sum(1 for status, _ in outcomes if status == 503)
+        other = len(outcomes) - len(latencies) - rejected
+        p50 = statistics.median(latencies) if latencies else float('nan')
+        p99 = percentile(latencies, 99) if latencies else float('nan')
+        print(f"{workers:>7} {len(latencies) / elapsed:>7.2f} {p50:>8.0f} {p99:>8.0f} "
+              f"{len(latencies):>4} {rejected:>4} {other:>5}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Synthetic image pairs for the benchmark scripts"""
+import cv2
+import numpy as np
+
+
+def make_scene(width, height, seed=0):
+    """Textured BGR scene with enough structure for every aligner to lock on"""
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(0, 256, (max(height // 16, 2), max(width // 16, 2), 3), dtype=np.uint8)
+    scene = cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+    for _ in range(40):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        w, h = int(rng.integers(width // 40 + 1, width // 8 + 2)), int(rng.integers(height // 40 + 1, height // 8 + 2))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.rectangle(scene, (x, y), (x + w, y + h), color, -1)
+    return scene
+
+
+def make_pair(width, height, shift=(0.0, 0.0), angle=0.0, seed=0):
+    """Return (reference, inspection) where the inspection is shifted/rotated and carries one defect"""
+    reference = make_scene(width, height, seed)
+    M = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    M[:, 2] += shift
+    inspection = cv2.warpAffine(reference, M, (width, height), borderMode=cv2.BORDER_REFLECT)
+    cx, cy = width // 2, height // 2
+    r = max(min(width, height) // 30, 4)
+    cv2.circle(inspection, (cx, cy), r, (0, 0, 0), -1)
+    return reference, inspection
+
+
+def encode_jpeg(image, quality=90):
+    _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes()
+
+
+def make_case(width, height, shift=(0.0, 0.0), angle=0.0, defects=5, noise=0.0, seed=0):
+    """Pair with ground truth: (reference, inspection, defect boxes as (x, y, w, h) in the inspection).
+
+    The inspection is the reference warped by the shift/rotation, with
+    non-overlapping dark, bright and colour-shifted patches painted on it.
+    noise is the sigma of Gaussian sensor noise added to both images.
+    """
+    rng = np.random.default_rng(seed + 1)
+    reference = make_scene(width, height, seed)
+    M = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    M[:, 2] += shift
+    inspection = cv2.warpAffine(reference, M, (width, height), borderMode=cv2.BORDER_REFLECT)
+
+    boxes = []
+    side = min(width, height)
+    margin = side // 10
+    while len(boxes) < defects:
+        w, h = (int(v) for v in rng.integers(side // 60 + 4, side // 25 + 6, 2))
+        x = int(rng.integers(margin, width - margin - w))
+        y = int(rng.integers(margin, height - margin - h))
+        if any(x < bx + bw + margin // 2 and bx < x + w + margin // 2 and
+               y < by + bh + margin // 2 and by < y + h + margin // 2 for bx, by, bw, bh in boxes):
+            continue
+        patch = inspection[y:y + h, x:x + w]
+        kind = len(boxes) % 3
+        if kind == 0:
+            cv2.ellipse(patch, (w // 2, h // 2), (w // 2, h // 2), 0, 0, 360, (0, 0, 0), -1)
+        elif kind == 1:
+            patch[:] = 255
+        else:
+            patch[:] = 255 - patch
+        boxes.append((x, y, w, h))
+
+    if noise > 0:
+        reference, inspection = (
+            np.clip(image + rng.standard_normal(image.shape, np.float32) * noise, 0, 255).astype(np.uint8)
+            for image in (reference, inspection))
+    return reference, inspection, boxes
@@ -0,0 +1,106 @@
+"""SSIM built on OpenCV's separable filters.
+
+Follows skimage.metrics.structural_similarity (uniform 7x7 window with sample
+covariance, or an 11x11 Gaussian with sigma 1.5), computed in float32 with
+reused buffers. The mean agrees with skimage to within SSIM_TOLERANCE on
+uint8 grayscale input.
+"""
+import cv2
+import numpy as np
+
+K1 = 0.01
+K2 = 0.03
+GAUSSIAN_WIN_SIZE = 11
+GAUSSIAN_SIGMA = 1.5
+SSIM_TOLERANCE = 1e-4  # Max absolute difference from skimage on uint8 input
+
+
+def _filter(src, dst, win_size, gaussian):
+    if gaussian:
+        return cv2.GaussianBlur(src, (win_size, win_size), GAUSSIAN_SIGMA, dst=dst,
+                                borderType=cv2.BORDER_REFLECT)
+    return cv2.boxFilter(src, -1, (win_size, win_size), dst=dst, normalize=True,
+                         borderType=cv2.BORDER_REFLECT)
+
+
+def ssim_map(gray1, gray2, win_size=7, gaussian=False, data_range=255):
+    """Per-pixel SSIM of two single-channel images as a float32 array"""
+    x = np.asarray(gray1, dtype=np.float32)
+    y = np.asarray(gray2, dtype=np.float32)
+    if gaussian:
+        win_size = GAUSSIAN_WIN_SIZE
+        cov_norm = 1.0
+    else:
+        cov_norm = win_size * win_size / (win_size * win_size - 1.0)
+    c1 = (K1 * data_range) ** 2
+    c2 = (K2 * data_range) ** 2
+
+    ux = _filter(x, None, win_size, gaussian)
+    uy = _filter(y, None, win_size, gaussian)
+    tmp = np.empty_like(x)
+    vx = _filter(cv2.multiply(x, x, dst=tmp), None, win_size, gaussian)
+    vy = _filter(cv2.multiply(y, y, dst=tmp), None, win_size, gaussian)
+    vxy = _filter(cv2.multiply(x, y, dst=tmp), None, win_size, gaussian)
+
+    # vx/vy/vxy become (co)variances in place; tmp holds ux * uy
+    cv2.multiply(ux, uy, dst=tmp)
+    cv2.subtract(vxy, tmp, dst=vxy)
+    cv2.multiply(ux, ux, dst=ux)
+    cv2.multiply(uy, uy, dst=uy)
+    cv2.subtract(vx, ux, dst=vx)
+    cv2.subtract(vy, uy, dst=vy)
+
+    # numerator = (2 ux uy + c1) * (2 cov_norm vxy + c2)
+    cv2.addWeighted(tmp, 2.0, tmp, 0.0, c1, dst=tmp)
+    cv2.addWeighted(vxy, 2.0 * cov_norm, vxy, 0.0, c2, dst=vxy)
+    cv2.multiply(tmp, vxy, dst=tmp)
+    # denominator = (ux^2 + uy^2 + c1) * (cov_norm (vx + vy) + c2)
+    cv2.add(ux, uy, dst=ux)
+    cv2.add(ux, c1, dst=ux)
+    cv2.add(vx, vy, dst=vx)
+    cv2.addWeighted(vx, cov_norm, vx, 0.0, c2, dst=vx)
+    cv2.multiply(ux, vx, dst=ux)
+    return cv2.divide(tmp, ux, dst=tmp)
+
+
+def structural_similarity(gray1, gray2, win_size=7, gaussian=False, downsample=1,
+                          tile_rows=None, full=False, data_range=255):
+    """Mean SSIM of two grayscale images, optionally with the SSIM map.
+
+    downsample > 1 scores INTER_AREA-reduced copies, which is what the SSIM
+    authors recommend for large images and is much cheaper. tile_rows bounds
+    memory by processing horizontal bands with a halo wide enough for the
+    filter window; the result is the same as the full-frame computation.
+    The map is returned at the (possibly downsampled) scoring resolution.
+    """
+    if gray1.shape != gray2.shape:
+        raise ValueError("Input images must have the same dimensions.")
+    if downsample > 1:
+        size = (max(gray1.shape[1] // downsample, 1), max(gray1.shape[0] // downsample, 1))
+        gray1 = cv2.resize(gray1, size, interpolation=cv2.INTER_AREA)
+        gray2 = cv2.resize(gray2, size, interpolation=cv2.INTER_AREA)
+    if gaussian:
+        win_size = GAUSSIAN_WIN_SIZE
+    pad = (win_size - 1) // 2
+    h, w = gray1.shape[:2]
+    if h <= 2 * pad or w <= 2 * pad:
+        raise ValueError("Images are smaller than the SSIM window.")
+
+    if tile_rows is None or tile_rows >= h:
+        S = ssim_map(gray1, gray2, win_size, gaussian, data_range)
+        mssim = float(S[pad:h - pad, pad:w - pad].mean(dtype=np.float64))
+        return (mssim, S) if full else mssim
+
+    S = np.empty((h, w), dtype=np.float32) if full else None
+    total = 0.0
+    for r0 in range(0, h, tile_rows):
+        r1 = min(r0 + tile_rows, h)
+        h0, h1 = max(r0 - pad, 0), min(r1 + pad, h)
+        band = ssim_map(gray1[h0:h1], gray2[h0:h1], win_size, gaussian, data_range)[r0 - h0:r1 - h0]
+        if full:
+            S[r0:r1] = band
+        v0, v1 = max(r0, pad) - r0, min(r1, h - pad) - r0
+        if v1 > v0:
+            total += float(band[v0:v1, pad:w - pad].sum(dtype=np.float64))
+    mssim = total / ((h - 2 * pad) * (w - 2 * pad))
+    return (mssim, S) if full else mssim
@@ -0,0 +1,260 @@
+"""Per-stage timing of comparisons, exported as Prometheus histograms.
+
+Code marks its stages with `with stage('detect'):` or `@timed('encode')`.
+A stage measures wall time, CPU time of the calling thread and, when
+tracemalloc is tracing, the peak of Python/numpy allocations (OpenCV
+results are numpy arrays; its internal buffers are not seen). Stages add
+up in the trace of the current thread, a dict of stage -> [wall, cpu,
+peak] that worker processes return with their results; closing a trace
+adds it to the process-wide histograms served by GET /metrics. Stages run
+outside any trace (background persistence) are recorded directly.
+
+Memory peaks need METRICS_TRACE_MEMORY=1. With METRICS_ENABLED=0, stage()
+returns a shared no-op and timed() leaves functions undecorated.
+"""
+import bisect
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from functools import wraps
+
+ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+TRACE_MEMORY = ENABLED and os.environ.get('METRICS_TRACE_MEMORY', '0') == '1'  # tracemalloc slows allocations
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(11))  # 1 MB to 1 GB
+
+_local = threading.local()
+
+if TRACE_MEMORY and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        """(le, cumulative count) pairs ending with +Inf"""
+        total = 0
+        for le, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield le, total
+
+
+def escape_label(value):
+    """A label value escaped for the Prometheus text format"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class StageMetrics:
+    METRICS = (
+        ('comparison_stage_seconds', 'Wall time spent in a comparison stage', SECONDS_BUCKETS),
+        ('comparison_stage_cpu_seconds', 'CPU time of the thread running a comparison stage', SECONDS_BUCKETS),
+        ('comparison_stage_peak_bytes', 'Peak traced allocations during a comparison stage', BYTES_BUCKETS),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {name: {} for name, _, _ in self.METRICS}
+
+    def observe(self, trace):
+        """Add a trace (stage -> [wall, cpu, peak]) to the histograms"""
+        with self._lock:
+            for stage_name, values in trace.items():
+                for (name, _, buckets), value in zip(self.METRICS, values):
+                    if value is None:
+                        continue
+                    histograms = self._histograms[name]
+                    if stage_name not in histograms:
+                        histograms[stage_name] = Histogram(buckets)
+                    histograms[stage_name].observe(value)
+
+    def render(self):
+        """The histograms in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, help_text, _ in self.METRICS:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                for stage_name, histogram in sorted(self._histograms[name].items()):
+                    label = escape_label(stage_name)
+                    for le, count in histogram.samples():
+                        lines.append(f'{name}_bucket{{stage="{label}",le="{le}"}} {count}')
+                    lines.append(f'{name}_sum{{stage="{label}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{stage="{label}"}} {sum(histogram.counts)}')
+        return '\n'.join(lines) + '\n'
+
+
+stage_metrics = StageMetrics()
+
+
+def add_to_trace(trace, stage_name, wall, cpu, peak):
+    totals = trace.get(stage_name)
+    if totals is None:
+        trace[stage_name] = [wall, cpu, peak]
+        return
+    totals[0] += wall
+    totals[1] += cpu
+    if peak is not None:
+        totals[2] = peak if totals[2] is None else max(totals[2], peak)
+
+
+def record(stage_name, wall, cpu, peak=None):
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        stage_metrics.observe({stage_name: [wall, cpu, peak]})
+    else:
+        add_to_trace(trace, stage_name, wall, cpu, peak)
+
+
+def merge_trace(other):
+    """Add the stages of a trace returned by another process or thread"""
+    for stage_name, (wall, cpu, peak) in (other or {}).items():
+        record(stage_name, wall, cpu, peak)
+
+
+class Trace:
+    """Collect the stages run by this thread; observe=False leaves them out of the histograms.
+
+    Traces nest: an inner trace hides its stages from the outer one, which
+    can merge_trace() them back (this is how worker results are accounted).
+    """
+    def __init__(self, observe=True):
+        self.observe = observe
+        self.stages = {}
+        self.started = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self._previous = getattr(_local, 'trace', None)
+        _local.trace = self.stages
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
+        _local.trace = self._previous
+        if self.observe and ENABLED:
+            stage_metrics.observe(self.stages)
+        return False
+
+    def breakdown(self):
+        """Per-stage milliseconds (and peak MB when traced) for an API response"""
+        stages = {}
+        for stage_name, (wall, cpu, peak) in self.stages.items():
+            stages[stage_name] = {'wall_ms': round(wall * 1000, 2), 'cpu_ms': round(cpu * 1000, 2)}
+            if peak is not None:
+                stages[stage_name]['peak_mb'] = round(peak / (1024 * 1024), 2)
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.started
+        return {'total_ms': round(elapsed * 1000, 2), 'stages': stages}
+
+
+class _Stage:
+    __slots__ = ('name', 'extra_cpu', '_wall', '_cpu', '_memory')
+
+    def __init__(self, name):
+        self.name = name
+        self.extra_cpu = 0.0
+
+    def add_cpu(self, seconds):
+        """Count CPU time spent for this stage on other threads"""
+        self.extra_cpu += seconds
+
+    def __enter__(self):
+        self._memory = None
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self._memory = tracemalloc.get_traced_memory()[0]
+        self._cpu = time.thread_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._wall
+        cpu = time.thread_time() - self._cpu + self.extra_cpu
+        # Peaks are only meaningful when one comparison runs at a time, as in a worker process
+        peak = tracemalloc.get_traced_memory()[1] - self._memory if self._memory is not None else None
+        record(self.name, wall, cpu, peak)
+        return False
+
+
+class _NoStage:
+    def add_cpu(self, seconds):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name):
+    """Context manager timing one stage into the current trace"""
+    return _Stage(name) if ENABLED else _NO_STAGE
+
+
+def timed(name):
+    """Decorator form of stage()"""
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _Stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class SamplingProfiler:
+    """Sample the Python stack of the calling thread every interval seconds.
+
+    folded() returns collapsed stacks ("outer;inner count" lines) for
+    flamegraph.pl or speedscope. A native call (OpenCV releases the GIL)
+    shows as the Python line that made it.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._thread_id = None
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self._thread_id = threading.get_ident()
+        self._sampler = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._sampler.join()
+        return False
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
@@ -0,0 +1,122 @@
+"""Background comparison jobs with idempotent submission.
+
+A job's analysis_id is derived from a client key (an Idempotency-Key header
+or a hash of the uploads, parameters and persisted artifacts), so re-sending
+the same upload returns the existing job instead of starting a new one.
+Finished jobs are dropped from memory; their
+results/<analysis_id>/analysis_summary.json is the record of completion.
+Failed and rejected jobs stay in memory with their error; only failed ones
+run again when resubmitted.
+"""
+import hashlib
+import json
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+JOB_NAMESPACE = uuid.UUID('6f1c2a0e-5d0b-4c43-9a55-2f7e8d1b3c90')
+MAX_FAILED_JOBS = 1000  # Failed jobs kept in memory so clients can read the error
+
+
+class JobQueueFullError(Exception):
+    """Raised when too many jobs are already queued or running"""
+
+
+class JobRejectedError(Exception):
+    """Raised by a job whose inputs can never succeed: it ends with status and details instead of 'failed'
+    and is not retried on resubmission"""
+    def __init__(self, message, status, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+
+def job_key(data1, data2, options, persist):
+    """Content hash of a submission: both uploads, the detection parameters and the persisted artifacts"""
+    digest = hashlib.sha256()
+    for data in (data1, data2):
+        digest.update(len(data).to_bytes(8, 'little'))
+        digest.update(data)
+    digest.update(json.dumps([options, sorted(persist)], sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def job_id_for_key(key):
+    return str(uuid.uuid5(JOB_NAMESPACE, key))
+
+
+class JobManager:
+    def __init__(self, max_workers, max_pending, is_done):
+        self.max_pending = max_pending
+        self.is_done = is_done
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        self._active = {}
+        self._failed = OrderedDict()
+
+    def submit(self, analysis_id, fn, *args):
+        """Start fn(analysis_id, *args) unless this job is already queued, running or done.
+
+        Returns (status, created); status is None when the job already finished.
+        A failed job is retried on resubmission, a rejected one is not.
+        """
+        with self._lock:
+            if analysis_id in self._active:
+                return dict(self._active[analysis_id]), False
+            failed = self._failed.get(analysis_id)
+            if failed is not None and failed['status'] != 'failed':
+                return dict(failed), False
+            # Checked under the lock: _run only forgets a job after fn has
+            # written its results, so a job cannot slip between the two checks
+            if self.is_done(analysis_id):
+                return None, False
+            if len(self._active) >= self.max_pending:
+                raise JobQueueFullError(f"{len(self._active)} jobs already pending")
+            self._failed.pop(analysis_id, None)
+            status = {
+                'analysis_id': analysis_id,
+                'status': 'queued',
+                'submitted_at': datetime.now().isoformat()
+            }
+            self._active[analysis_id] = status
+        self._executor.submit(self._run, analysis_id, fn, args)
+        return dict(status), True
+
+    def _run(self, analysis_id, fn, args):
+        with self._lock:
+            self._active[analysis_id]['status'] = 'running'
+            self._active[analysis_id]['started_at'] = datetime.now().isoformat()
+        try:
+            fn(analysis_id, *args)
+        except Exception as e:
+            if isinstance(e, JobRejectedError):
+                logger.warning(f"Job {analysis_id} {e.status}: {e}")
+                outcome = {'status': e.status, **e.details}
+            else:
+                logger.error(f"Job {analysis_id} failed: {e}")
+                outcome = {'status': 'failed'}
+            with self._lock:
+                status = self._active.pop(analysis_id)
+                status.update(outcome, error=str(e), finished_at=datetime.now().isoformat())
+                self._failed[analysis_id] = status
+                while len(self._failed) > MAX_FAILED_JOBS:
+                    self._failed.popitem(last=False)
+        else:
+            with self._lock:
+                self._active.pop(analysis_id, None)
+            logger.info(f"Job {analysis_id} done")
+
+    def get(self, analysis_id):
+        """Status of a queued, running or failed job, or None if not tracked in memory"""
+        with self._lock:
+            status = self._active.get(analysis_id) or self._failed.get(analysis_id)
+            return dict(status) if status else None
+
+    def stats(self):
+        with self._lock:
+            return {'pending': len(self._active), 'failed': len(self._failed), 'max_pending': self.max_pending}
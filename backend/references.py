@@ -0,0 +1,127 @@
+"""On-disk registry of reference images with precomputed alignment data.
+
+A reference is stored once at working resolution together with the views
+the aligners need (grayscale, ORB keypoints/descriptors, DFT spectrum), so
+comparisons against it only process the inspection image. Ids are content
+hashes: registering the same upload twice returns the same reference.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+REFERENCE_ID_LENGTH = 32
+
+
+def reference_id_for(data):
+    return hashlib.blake2b(data, digest_size=REFERENCE_ID_LENGTH // 2).hexdigest()
+
+
+def is_reference_id(value):
+    return len(value) == REFERENCE_ID_LENGTH and all(c in '0123456789abcdef' for c in value)
+
+
+def keypoints_to_array(keypoints):
+    return np.float32([(k.pt[0], k.pt[1], k.size, k.angle, k.response, k.octave, k.class_id)
+                       for k in keypoints]).reshape(-1, 7)
+
+
+def keypoints_from_array(array):
+    return tuple(cv2.KeyPoint(float(x), float(y), float(size), float(angle), float(response), int(octave),
+                              int(class_id))
+                 for x, y, size, angle, response, octave, class_id in array)
+
+
+class ReferenceStore:
+    def __init__(self, folder, max_loaded=8):
+        self.folder = folder
+        self.max_loaded = max_loaded
+        self._lock = threading.Lock()
+        self._loaded = OrderedDict()
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, reference_id):
+        return os.path.join(self.folder, reference_id + '.npz')
+
+    def _index_path(self):
+        return os.path.join(self.folder, 'index.json')
+
+    def _read_index(self):
+        try:
+            with open(self._index_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        path = self._index_path()
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def exists(self, reference_id):
+        return is_reference_id(reference_id) and os.path.exists(self._path(reference_id))
+
+    def save(self, reference_id, arrays, metadata):
+        """Store arrays (bgr, gray, keypoints, descriptors, spectrum) and list the reference in the index"""
+        path = self._path(reference_id)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(path + '.tmp', path)
+        with self._lock:
+            index = self._read_index()
+            index[reference_id] = {**metadata, 'created_at': datetime.now().isoformat()}
+            self._write_index(index)
+            return dict(index[reference_id])
+
+    def load(self, reference_id):
+        """Stored arrays of a reference; the most recently used ones stay in memory.
+
+        Raises KeyError for an unknown reference.
+        """
+        with self._lock:
+            if reference_id in self._loaded:
+                self._loaded.move_to_end(reference_id)
+                return self._loaded[reference_id]
+        if not self.exists(reference_id):
+            raise KeyError(reference_id)
+        with np.load(self._path(reference_id)) as data:
+            arrays = {name: data[name] for name in data.files}
+        with self._lock:
+            self._loaded[reference_id] = arrays
+            while len(self._loaded) > self.max_loaded:
+                self._loaded.popitem(last=False)
+        return arrays
+
+    def get(self, reference_id):
+        """Index entry of a reference, or None"""
+        with self._lock:
+            return self._read_index().get(reference_id)
+
+    def list(self):
+        with self._lock:
+            return self._read_index()
+
+    def delete(self, reference_id):
+        """Remove a reference; returns False if it did not exist"""
+        if not is_reference_id(reference_id):
+            return False
+        with self._lock:
+            index = self._read_index()
+            found = index.pop(reference_id, None) is not None
+            if found:
+                self._write_index(index)
+            self._loaded.pop(reference_id, None)
+        try:
+            os.remove(self._path(reference_id))
+        except OSError:
+            pass
+        return found
@@ -0,0 +1,144 @@
+"""Content-addressed cache of comparison stages.
+
+Entries are keyed on a hash of the uploaded bytes plus the parameters a
+stage depends on, so resubmitting the same pair with other thresholds can
+skip decoding and alignment. Each tier is a size-bounded LRU in memory,
+optionally backed by pickles on disk that survive restarts and are shared
+between server processes.
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def upload_digest(data1, data2):
+    """Hash of both uploads; blake2b is several times faster than sha256 here"""
+    digest = hashlib.blake2b(digest_size=16)
+    for data in (data1, data2):
+        digest.update(len(data).to_bytes(8, 'little'))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def cache_key(parent, **params):
+    """Key derived from a parent key (or upload digest) and stage parameters"""
+    digest = hashlib.blake2b(parent.encode('utf-8'), digest_size=16)
+    digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def value_size(value):
+    """Approximate memory held by a cached value, counting numpy buffers"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(value_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(value_size(v) for v in value)
+    return 64
+
+
+class ResultCache:
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir if disk_max_bytes > 0 else None
+        self.disk_max_bytes = disk_max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._counters = {}
+
+    def _count(self, tier, event):
+        counters = self._counters.setdefault(tier, {'hits': 0, 'disk_hits': 0, 'misses': 0})
+        counters[event] += 1
+
+    def _disk_path(self, tier, key):
+        return os.path.join(self.disk_dir, tier, key + '.pkl')
+
+    def _remember(self, tier, key, value):
+        size = value_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop((tier, key), None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[(tier, key)] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def get(self, tier, key):
+        """Cached value or None; values are shared, callers must not modify them"""
+        with self._lock:
+            entry = self._entries.get((tier, key))
+            if entry is not None:
+                self._entries.move_to_end((tier, key))
+                self._count(tier, 'hits')
+                return entry[0]
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(tier, key), 'rb') as f:
+                    value = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+            else:
+                self._remember(tier, key, value)
+                with self._lock:
+                    self._count(tier, 'disk_hits')
+                return value
+        with self._lock:
+            self._count(tier, 'misses')
+        return None
+
+    def put(self, tier, key, value):
+        self._remember(tier, key, value)
+        if not self.disk_dir:
+            return
+        path = self._disk_path(tier, key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+            self._prune_disk()
+        except OSError as e:
+            logger.warning(f"Cannot write cache entry {tier}/{key}: {e}")
+
+    def _prune_disk(self):
+        """Delete the least recently written entries beyond disk_max_bytes"""
+        files = []
+        for tier in os.listdir(self.disk_dir):
+            tier_dir = os.path.join(self.disk_dir, tier)
+            for entry in os.scandir(tier_dir):
+                if entry.name.endswith('.pkl'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'disk': self.disk_dir is not None,
+                'tiers': {tier: dict(counters) for tier, counters in self._counters.items()}
+            }
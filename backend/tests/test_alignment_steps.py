@@ -0,0 +1,25 @@
+import pytest
+
+from app import parse_alignment_steps, parse_comparison_options
+
+
+def test_parses_method_and_minimum():
+    assert parse_alignment_steps('phase:0.3, ecc_pyramid:0.8,features:20') == [
+        ('phase', 0.3), ('ecc_pyramid', 0.8), ('features', 20.0)]
+
+
+@pytest.mark.parametrize('value', ['', 'auto:0.5', 'phase:0.3,ecs:0.8', 'phase', 'phase:high'])
+def test_rejects_invalid_steps(value):
+    with pytest.raises(ValueError):
+        parse_alignment_steps(value)
+
+
+@pytest.mark.parametrize('method', ['phase', 'ecc_pyramid', 'auto'])
+def test_accepts_known_alignment_methods(method):
+    assert parse_comparison_options({'alignment_method': method})['alignment_method'] == method
+
+
+@pytest.mark.parametrize('method', ['', 'PHASE', 'phase"} 1\nevil_metric{a="'])
+def test_rejects_unknown_alignment_methods(method):
+    with pytest.raises(ValueError):
+        parse_comparison_options({'alignment_method': method})
@@ -0,0 +1,26 @@
+import os
+import time
+
+from analysis_index import remove_stale_entries
+
+
+def age(path, seconds):
+    stamp = time.time() - seconds
+    os.utime(path, (stamp, stamp))
+
+
+def test_remove_stale_entries_removes_old_files_and_folders(tmp_path):
+    (tmp_path / 'old' / 'sub').mkdir(parents=True)
+    (tmp_path / 'fresh').mkdir()
+    for name in ('a_image1_scaled_1.jpg', 'old/image1.jpg', 'old/sub/image2.jpg', 'fresh/image1.jpg', 'new.jpg'):
+        (tmp_path / name).write_bytes(b'x')
+    for name in ('a_image1_scaled_1.jpg', 'old/image1.jpg', 'old/sub/image2.jpg', 'old/sub', 'old', 'fresh'):
+        age(tmp_path / name, 3600)
+
+    assert remove_stale_entries(tmp_path, 600) == 2
+    # A folder counts as recent when anything inside it is
+    assert sorted(os.listdir(tmp_path)) == ['fresh', 'new.jpg']
+
+
+def test_remove_stale_entries_ignores_missing_folder(tmp_path):
+    assert remove_stale_entries(tmp_path / 'missing', 600) == 0
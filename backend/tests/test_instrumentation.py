@@ -0,0 +1,9 @@
+from instrumentation import StageMetrics
+
+
+def test_render_escapes_label_values():
+    metrics = StageMetrics()
+    metrics.observe({'align_phase"} 1\nevil_metric{a="\\': [0.01, 0.01, None]})
+    text = metrics.render()
+    assert 'stage="align_phase\\"} 1\\nevil_metric{a=\\"\\\\"' in text
+    assert not any(line.startswith('evil_metric') for line in text.splitlines())
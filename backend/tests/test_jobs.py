@@ -0,0 +1,38 @@
+import time
+
+from jobs import JobManager, JobRejectedError, job_key
+
+
+def finished_status(manager, analysis_id):
+    deadline = time.monotonic() + 5
+    while manager.get(analysis_id)['status'] in ('queued', 'running') and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return manager.get(analysis_id)
+
+
+def test_failed_job_runs_again_on_resubmission():
+    manager = JobManager(1, 4, lambda analysis_id: False)
+    def fail(analysis_id):
+        raise RuntimeError('disk full')
+    manager.submit('a', fail)
+    status = finished_status(manager, 'a')
+    assert status['status'] == 'failed' and status['error'] == 'disk full'
+    assert manager.submit('a', lambda analysis_id: None)[1]
+
+
+def test_rejected_job_keeps_its_outcome_on_resubmission():
+    manager = JobManager(1, 4, lambda analysis_id: False)
+    def reject(analysis_id):
+        raise JobRejectedError('low response', 'unalignable', alignment={'value': 0.01})
+    manager.submit('a', reject)
+    status = finished_status(manager, 'a')
+    assert status['status'] == 'unalignable' and status['alignment'] == {'value': 0.01}
+    status, created = manager.submit('a', lambda analysis_id: None)
+    assert not created and status['status'] == 'unalignable'
+
+
+def test_job_key_depends_on_persisted_artifacts():
+    options = {'sensitivity': 25}
+    key = job_key(b'a', b'b', options, ['threshold_map', 'superposition'])
+    assert key == job_key(b'a', b'b', options, ['superposition', 'threshold_map'])
+    assert key != job_key(b'a', b'b', options, ['threshold_map'])
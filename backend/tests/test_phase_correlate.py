@@ -0,0 +1,61 @@
+"""phase_correlate on precomputed spectra against known sub-pixel shifts.
+
+Sizes are odd and even DFT sizes: cv2.phaseCorrelate centres its peak on
+size / 2.0, which biases odd sizes by half a pixel; phase_correlate must not.
+"""
+import cv2
+import numpy as np
+import pytest
+
+from app import normalize_ccs, phase_correlate, phase_spectrum
+
+SIZES = [(128, 128), (96, 160), (125, 135), (135, 125), (81, 75)]
+SHIFTS = [(0.0, 0.0), (3.0, -2.0), (3.25, -1.5), (-7.6, 4.4), (0.5, 0.5), (1.75, -0.25)]
+
+
+@pytest.fixture(scope='module')
+def scene():
+    rng = np.random.default_rng(0)
+    texture = cv2.GaussianBlur(rng.random((600, 600), np.float32), (0, 0), 1.5)
+    return texture - texture.mean()
+
+
+def crop(scene, shift, size):
+    """Window of scene whose content is moved by shift (x, y), resampled with cubic interpolation"""
+    h, w = size
+    M = np.float32([[1, 0, shift[0]], [0, 1, shift[1]]])
+    moved = cv2.warpAffine(scene, M, scene.shape[::-1], flags=cv2.INTER_CUBIC)
+    return moved[200:200 + h, 200:200 + w] * cv2.createHanningWindow((w, h), cv2.CV_32F)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_known_shifts(scene, size):
+    reference = phase_spectrum(crop(scene, (0, 0), size))
+    errors = []
+    for shift in SHIFTS:
+        (dx, dy), response = phase_correlate(reference, phase_spectrum(crop(scene, shift, size)))
+        assert response > 0.5
+        assert abs(dx - shift[0]) < 0.35 and abs(dy - shift[1]) < 0.35, (shift, (dx, dy))
+        errors.append((dx - shift[0], dy - shift[1]))
+    # No systematic offset, whatever the parity of the size
+    bias_x, bias_y = np.mean(errors, axis=0)
+    assert abs(bias_x) < 0.15 and abs(bias_y) < 0.15
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_identical_images_have_zero_shift(scene, size):
+    spectrum = phase_spectrum(crop(scene, (0, 0), size))
+    (dx, dy), response = phase_correlate(spectrum, spectrum.copy())
+    assert abs(dx) < 1e-3 and abs(dy) < 1e-3
+    assert response == pytest.approx(1.0, abs=0.05)
+
+
+@pytest.mark.parametrize('size', [(8, 8), (8, 7), (7, 8), (7, 7)])
+def test_normalize_ccs_gives_unit_magnitudes(size):
+    rng = np.random.default_rng(1)
+    spectrum = cv2.dft(rng.random(size, np.float32) - 0.5)
+    normalized = normalize_ccs(spectrum.copy())
+    # Unpacked to full complex form, every non-zero coefficient has magnitude 1
+    full = cv2.dft(cv2.idft(normalized, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT), flags=cv2.DFT_COMPLEX_OUTPUT)
+    magnitudes = np.hypot(full[..., 0], full[..., 1])
+    np.testing.assert_allclose(magnitudes, 1.0, atol=1e-4)
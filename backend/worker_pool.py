@@ -0,0 +1,133 @@
+"""Bounded process pool that runs comparisons outside the request threads.
+
+Each worker process is warmed up once (OpenCV thread count, imports, a tiny
+comparison) and then serves jobs. At most workers + queue_depth jobs are
+admitted; further submissions fail fast with PoolBusyError so the API can
+answer 503 instead of piling up requests. A job that runs past the timeout
+cannot be interrupted, so the executor is recycled: its processes are killed
+and a fresh set of workers takes over.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Workers start lazily and on restart(), while the server's threads may hold locks (logging handlers among
+# them) that a forked child would inherit held; forkserver children start from a clean single-threaded process
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+class PoolBusyError(Exception):
+    """Raised when every worker is busy and the queue is full"""
+
+
+class JobTimeoutError(Exception):
+    """Raised when a job does not finish within the pool's job timeout"""
+
+
+def _init_worker(cv_threads):
+    cv2.setNumThreads(cv_threads)
+    from app import PreciseImageDifferenceDetector
+    warmup = np.zeros((64, 64, 3), np.uint8)
+    PreciseImageDifferenceDetector().process_images_from_arrays(warmup, warmup)
+    logger.info(f"Worker {os.getpid()} ready ({cv_threads} OpenCV threads)")
+
+
+class ComparisonPool:
+    def __init__(self, workers, queue_depth, job_timeout, cv_threads=None):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.job_timeout = job_timeout
+        # Split the cores between processes so OpenCV does not oversubscribe them
+        self.cv_threads = cv_threads or max(1, (os.cpu_count() or 1) // workers)
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._executor = self._create_executor()
+
+    def _create_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(START_METHOD),
+                                   initializer=_init_worker, initargs=(self.cv_threads,))
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) on a worker, or raise PoolBusyError if the queue is full.
+
+        The future's executor attribute is the executor running it, for restart().
+        """
+        if not self._slots.acquire(blocking=False):
+            raise PoolBusyError(f"All {self.workers} workers busy and {self.queue_depth} jobs queued")
+        with self._lock:
+            self._pending += 1
+            executor = self._executor
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException:
+            self._release(None)
+            raise
+        future.executor = executor
+        future.add_done_callback(self._release)
+        return future
+
+    def run(self, fn, *args):
+        """Run fn(*args) on a worker and wait up to job_timeout seconds for the result.
+
+        A job that times out is stopped by recycling the executor. Jobs
+        that were lost only because another job's worker was recycled or
+        died are submitted once more, within the same deadline.
+        """
+        deadline = time.monotonic() + self.job_timeout
+        for attempt in range(2):
+            future = self.submit(fn, *args)
+            try:
+                return future.result(timeout=max(0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                self.restart(future.executor, f"Job exceeded {self.job_timeout:.0f}s")
+                raise JobTimeoutError(f"Comparison exceeded {self.job_timeout:.0f}s")
+            except (BrokenProcessPool, CancelledError):
+                if self.restart(future.executor) or attempt:
+                    raise
+                logger.warning("Job lost to a pool restart, resubmitting")
+
+    def restart(self, executor=None, reason="Worker process died"):
+        """Replace executor (the current one by default) and kill its processes.
+
+        Returns False when executor was already replaced, so concurrent
+        callers seeing the same failure restart the pool only once.
+        """
+        with self._lock:
+            if executor is not None and executor is not self._executor:
+                return False
+            old, self._executor = self._executor, self._create_executor()
+        logger.error(f"{reason}, restarting pool")
+        # ProcessPoolExecutor cannot stop a running job; terminating its processes breaks the old executor,
+        # which fails the futures still attached to it
+        for process in list((old._processes or {}).values()):
+            process.terminate()
+        old.shutdown(wait=False, cancel_futures=True)
+        return True
+
+    def stats(self):
+        with self._lock:
+            pending = self._pending
+        return {
+            'workers': self.workers,
+            'queue_depth': self.queue_depth,
+            'in_flight': pending,
+            'opencv_threads_per_worker': self.cv_threads
+        }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,26 @@
+"""Production entry point for the comparison API.
+
+    python wsgi.py                              # waitress, works on Windows too
+    gunicorn -w 1 --threads 16 -t 200 wsgi:app  # Linux
+
+Run a single server process: CPU-bound comparisons go to the worker pool
+(WORKER_PROCESSES, WORKER_QUEUE_DEPTH, WORKER_JOB_TIMEOUT) and the server
+threads only handle I/O. With WORKER_PROCESSES unset, one process per core
+is used. Importing this module reconciles results/ with its index, removes
+stale uploads and starts the background eviction (RESULTS_TTL_HOURS,
+RESULTS_MAX_MB).
+"""
+import os
+
+os.environ.setdefault('WORKER_PROCESSES', str(os.cpu_count() or 1))
+
+from app import app, start_maintenance  # noqa: E402
+
+start_maintenance()
+
+if __name__ == '__main__':
+    from waitress import serve
+    threads = int(os.environ.get('SERVER_THREADS', 16))
+    print(f"Serving on http://0.0.0.0:5000 with {threads} threads, "
+          f"{os.environ['WORKER_PROCESSES']} worker processes")
+    serve(app, host='0.0.0.0', port=5000, threads=threads)